@@ -3,34 +3,65 @@
 #  This file is now TINY and CLEAN. It only creates the app and registers blueprints
 # =============================================================================
 
+import os
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+from psycopg.errors import QueryCanceled
 from extensions import get_db, close_db, money, format_date
 from routes.auth import auth_bp
 from routes.client import client_bp
 from routes.case import case_bp
-from routes.reports import reports_bp
+from routes.reports import reports_bp, reports_cli
 from routes.admin import admin_bp
+from routes.bulk import bulk_bp
+from routes.case_api import case_api_bp
+from archive import archive_cli
+from fragment_cache import fragment
+from dedupe import dedupe_cli
+from ledger_export import export_cli
+from statements import statements_cli
+from profiler import init_profiler
+from load_limits import handle_query_canceled
+
+# How many proxies in front of gunicorn set X-Forwarded-For (0 = none, use the socket address).
+# request.remote_addr is then the real client - the login IP throttle depends on it.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 1))
 
 
 def create_app():
     app = Flask(__name__)
     app.secret_key = 'supersecretkey'  # TODO: move to env var
+    if TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 
     app.teardown_appcontext(close_db)
+    init_profiler(app)   # admin-only, opt-in - see profiler.py
+    app.register_error_handler(QueryCanceled, handle_query_canceled)   # statement_timeout hit - see load_limits.py
 
     app.register_blueprint(auth_bp)
     app.register_blueprint(client_bp)
     app.register_blueprint(case_bp)
     app.register_blueprint(reports_bp)
     app.register_blueprint(admin_bp)
+    app.register_blueprint(bulk_bp)
+    app.register_blueprint(case_api_bp)
+
+    app.cli.add_command(archive_cli)
+    app.cli.add_command(reports_cli)
+    app.cli.add_command(dedupe_cli)
+    app.cli.add_command(export_cli)
+    app.cli.add_command(statements_cli)
 
     app.jinja_env.filters['money'] = money
     app.jinja_env.filters['format_date'] = format_date
+    app.jinja_env.globals['fragment'] = fragment
 
     return app
 
 
 # This is what Gunicorn needs — the app object at module level
+# Safe to build under gunicorn --preload (see gunicorn.conf.py): creating the app
+# opens no DB connections or threads, get_db() only connects inside a request.
 app = create_app()
 
 
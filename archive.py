@@ -0,0 +1,184 @@
+# =============================================================================
+#  ARCHIVE - MOVES CLOSED-CASE HISTORY OUT OF THE LIVE TABLES
+#  • money, notes and case_status_history for cases closed longer than
+#    ARCHIVE_AFTER_DAYS are moved into money_archive / notes_archive /
+#    case_status_history_archive (created in init_db.py)
+#  • Runs in small batches with a pause between them so it never hogs the DB
+#  • Progress is stored in archive_checkpoint so a killed run just carries on
+#  • The *_all views (live + archive) are what you read from when you need
+#    archived rows back - see source(). Changing an archived row restores
+#    its case first (restore_if_archived) - the archive is never written to
+#  Run it from cron:   flask --app app archive run
+# =============================================================================
+
+import os
+import time
+import click
+from flask.cli import AppGroup
+from psycopg import sql
+from extensions import get_db
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 730))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 200))
+ARCHIVE_PAUSE_SECONDS = float(os.environ.get('ARCHIVE_PAUSE_SECONDS', 0.5))
+
+# Child tables that get archived with their case (order doesn't matter, no FKs between them)
+ARCHIVED_TABLES = ('money', 'notes', 'case_status_history')
+
+CHECKPOINT_NAME = 'closed_cases'
+
+
+def source(table, archived):
+    """Table (or view) to read a case's rows from.
+    Live cases only ever touch the live table; archived ones read live + archive."""
+    return f"{table}_all" if archived else table
+
+
+def _columns(c, table):
+    # Column list of the LIVE table - the archive has the same columns plus archived_at
+    c.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
+        ORDER BY ordinal_position
+    """, (table,))
+    return [sql.Identifier(r['column_name']) for r in c.fetchall()]
+
+
+def _move(c, from_table, to_table, cols, case_ids):
+    c.execute(sql.SQL("""
+        WITH moved AS (
+            DELETE FROM {src} WHERE case_id = ANY(%s) RETURNING {cols}
+        )
+        INSERT INTO {dst} ({cols}) SELECT {cols} FROM moved
+    """).format(
+        src=sql.Identifier(from_table),
+        dst=sql.Identifier(to_table),
+        cols=sql.SQL(', ').join(cols),
+    ), (case_ids,))
+    return c.rowcount
+
+
+def archive_cases(db, case_ids):
+    """Move every child row of the given cases into the archive tables (caller commits)."""
+    c = db.cursor()
+    moved = {}
+    for table in ARCHIVED_TABLES:
+        moved[table] = _move(c, table, f"{table}_archive", _columns(c, table), list(case_ids))
+    c.execute("UPDATE cases SET archived_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)", (list(case_ids),))
+    return moved
+
+
+def restore_case(db, case_id):
+    """Bring an archived case back into the live tables, e.g. when it gets re-opened (caller commits)."""
+    c = db.cursor()
+    for table in ARCHIVED_TABLES:
+        _move(c, f"{table}_archive", table, _columns(c, table), [case_id])
+    c.execute("UPDATE cases SET archived_at = NULL WHERE id = %s", (case_id,))
+
+
+def restore_if_archived(db, case_id):
+    """Restore the case first if it's archived, so its rows can be changed in the live tables
+    (caller commits). Returns True if it had to be restored."""
+    c = db.cursor()
+    c.execute("SELECT archived_at FROM cases WHERE id = %s", (case_id,))
+    row = c.fetchone()
+    if not row or row['archived_at'] is None:
+        return False
+    restore_case(db, case_id)
+    return True
+
+
+def case_of(db, table, row_id):
+    """case_id of a money / notes row, live or archived - None if there's no such row."""
+    c = db.cursor()
+    c.execute(f"SELECT case_id FROM {table}_all WHERE id = %s", (row_id,))
+    row = c.fetchone()
+    return row['case_id'] if row else None
+
+
+def _next_batch(c, after_id, older_than_days, batch_size):
+    # "Closed since" = the last status change on the case, or open_date if it never had one
+    c.execute("""
+        SELECT s.id
+        FROM cases s
+        WHERE s.id > %s
+          AND s.status = 'Closed'
+          AND s.archived_at IS NULL
+          AND COALESCE(
+                (SELECT MAX(h.changed_at) FROM case_status_history h WHERE h.case_id = s.id),
+                s.open_date
+              ) < CURRENT_TIMESTAMP - make_interval(days => %s)
+        ORDER BY s.id
+        LIMIT %s
+    """, (after_id, older_than_days, batch_size))
+    return [r['id'] for r in c.fetchall()]
+
+
+def run_archive(db, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                pause=ARCHIVE_PAUSE_SECONDS, max_batches=None, log=print):
+    """Archive closed cases batch by batch, committing (and checkpointing) after each one.
+    Picks up from the saved checkpoint; the checkpoint goes back to 0 once a full pass is done."""
+    c = db.cursor()
+    c.execute("""
+        INSERT INTO archive_checkpoint (name, last_case_id) VALUES (%s, 0)
+        ON CONFLICT (name) DO NOTHING
+    """, (CHECKPOINT_NAME,))
+    c.execute("SELECT last_case_id FROM archive_checkpoint WHERE name = %s", (CHECKPOINT_NAME,))
+    last_id = c.fetchone()['last_case_id']
+    db.commit()
+
+    batches = 0
+    total_cases = 0
+    while max_batches is None or batches < max_batches:
+        case_ids = _next_batch(c, last_id, older_than_days, batch_size)
+        if not case_ids:
+            # Full pass finished - next run starts from the beginning again
+            c.execute("""
+                UPDATE archive_checkpoint SET last_case_id = 0, updated_at = CURRENT_TIMESTAMP
+                WHERE name = %s
+            """, (CHECKPOINT_NAME,))
+            db.commit()
+            break
+
+        moved = archive_cases(db, case_ids)
+        last_id = case_ids[-1]
+        c.execute("""
+            UPDATE archive_checkpoint SET last_case_id = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE name = %s
+        """, (last_id, CHECKPOINT_NAME))
+        db.commit()
+
+        batches += 1
+        total_cases += len(case_ids)
+        log(f"batch {batches}: {len(case_ids)} cases up to #{last_id} "
+            f"({', '.join(f'{t}={n}' for t, n in moved.items())})")
+        if pause:
+            time.sleep(pause)
+
+    return total_cases
+
+
+# =============================================================================
+#  CLI - registered in app.py
+# =============================================================================
+
+archive_cli = AppGroup('archive', help='Archive history of long-closed cases.')
+
+
+@archive_cli.command('run')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True, help='Archive cases closed longer than this.')
+@click.option('--batch-size', default=ARCHIVE_BATCH_SIZE, show_default=True)
+@click.option('--pause', default=ARCHIVE_PAUSE_SECONDS, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--max-batches', type=int, default=None, help='Stop after this many batches (resume next run).')
+def archive_run(days, batch_size, pause, max_batches):
+    total = run_archive(get_db(), days, batch_size, pause, max_batches, log=click.echo)
+    click.echo(f"Archived {total} cases")
+
+
+@archive_cli.command('restore')
+@click.argument('case_id', type=int)
+def archive_restore(case_id):
+    db = get_db()
+    restore_case(db, case_id)
+    db.commit()
+    click.echo(f"Case {case_id} restored")
@@ -0,0 +1,246 @@
+# =============================================================================
+#  AUTOCOMPLETE - /search AND /client_search ON ASYNCIO, OFF THE GUNICORN WORKERS
+#  The search box asks on every keystroke. On the sync workers each of those
+#  ties up a whole worker and runs to the end even when the user has typed
+#  on and nobody wants the answer. This is a small ASGI app instead:
+#      uvicorn autocomplete:app --port 8002 --workers 2
+#  with the proxy sending /search and /client_search to it (same cookie, same
+#  origin) - the rule is in deploy/nginx.conf. Without it the Flask routes in
+#  routes/case.py still answer, using the same SQL from here, but every
+#  (debounced) keystroke then costs a sync worker.
+#  • Superseded queries are cancelled: each browser tab sends its own `tab`
+#    id. A new lookup from the same user + tab cancels the one still running,
+#    and psycopg cancels it on the server too. The old request gets 409.
+#  • Results are cached for AUTOCOMPLETE_CACHE_SECONDS. If a shorter prefix of
+#    the query is cached and wasn't cut off at the row limit, the answer is
+#    filtered from it in Python - "smit" after "smi" needs no query at all.
+#  • Latency budget: a lookup that can't finish (connection wait included)
+#    within AUTOCOMPLETE_BUDGET_MS is cancelled and answered 503. The
+#    connections carry the same statement_timeout.
+#  • Auth: the Flask session cookie, checked with the Flask app's secret key
+#  Server-Timing on every answer says how long it took and where it came from.
+# =============================================================================
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+import psycopg
+from psycopg.rows import dict_row
+from extensions import DATABASE_URL
+
+AUTOCOMPLETE_BUDGET_MS = int(os.environ.get('AUTOCOMPLETE_BUDGET_MS', 300))
+AUTOCOMPLETE_POOL_SIZE = int(os.environ.get('AUTOCOMPLETE_POOL_SIZE', 5))
+AUTOCOMPLETE_CACHE_SECONDS = float(os.environ.get('AUTOCOMPLETE_CACHE_SECONDS', 30))
+AUTOCOMPLETE_CACHE_SIZE = int(os.environ.get('AUTOCOMPLETE_CACHE_SIZE', 5000))
+
+
+# ----------------------------------------------------------------------
+#  THE LOOKUPS - shared with the Flask routes in routes/case.py
+# ----------------------------------------------------------------------
+SEARCH_LIMIT = 50
+SEARCH_SQL = """
+    SELECT DISTINCT
+        c.id as client_id, c.business_name as client_name,
+        s.id as case_id,
+        COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last) as debtor_name,
+        s.postcode, s.email, s.phone
+    FROM cases s
+    JOIN clients c ON s.client_id = c.id
+    WHERE LOWER(c.business_name) LIKE %(like)s
+       OR LOWER(COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last)) LIKE %(like)s
+       OR LOWER(s.email || '') LIKE %(like)s
+       OR LOWER(s.phone || '') LIKE %(like)s
+       OR LOWER(s.postcode || '') LIKE %(like)s
+    ORDER BY c.business_name, s.id
+    LIMIT %(limit)s
+"""
+CLIENT_SEARCH_LIMIT = 20
+CLIENT_SEARCH_SQL = """
+    SELECT id, business_name as name FROM clients
+    WHERE LOWER(business_name) LIKE %(like)s
+    ORDER BY business_name
+    LIMIT %(limit)s
+"""
+
+# path: (sql, row limit, the result fields the LIKE matched on)
+LOOKUPS = {
+    '/search': (SEARCH_SQL, SEARCH_LIMIT, ('client_name', 'debtor_name', 'email', 'phone', 'postcode')),
+    '/client_search': (CLIENT_SEARCH_SQL, CLIENT_SEARCH_LIMIT, ('name',)),
+}
+
+
+def lookup_params(path, q):
+    return {'like': f"%{q.lower()}%", 'limit': LOOKUPS[path][1]}
+
+
+# ----------------------------------------------------------------------
+#  PREFIX CACHE
+# ----------------------------------------------------------------------
+_cache = OrderedDict()   # (path, q) -> (expires_at, rows)
+
+
+def _cached(path, q):
+    """(rows, how) from the cache - exact hit, or narrowed from a shorter prefix."""
+    now = time.monotonic()
+    _, limit, fields = LOOKUPS[path]
+    for n in range(len(q), 0, -1):
+        hit = _cache.get((path, q[:n]))
+        if not hit or hit[0] < now:
+            continue
+        rows = hit[1]
+        if n == len(q):
+            _cache.move_to_end((path, q))
+            return rows, 'cache'
+        if len(rows) < limit:
+            # everything matching q also matched the shorter prefix, and that answer was complete
+            rows = [r for r in rows if any(q in (r[f] or '').lower() for f in fields)]
+            _remember(path, q, rows)
+            return rows, 'prefix'
+    return None, None
+
+
+def _remember(path, q, rows):
+    _cache[(path, q)] = (time.monotonic() + AUTOCOMPLETE_CACHE_SECONDS, rows)
+    _cache.move_to_end((path, q))
+    while len(_cache) > AUTOCOMPLETE_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+# ----------------------------------------------------------------------
+#  CONNECTIONS - a few autocommit connections, reused; one that was
+#  cancelled mid-query or broke is closed rather than handed out again
+# ----------------------------------------------------------------------
+_idle = []
+_slots = None
+
+
+@asynccontextmanager
+async def _connection():
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(AUTOCOMPLETE_POOL_SIZE)
+    async with _slots:
+        conn = _idle.pop() if _idle else await psycopg.AsyncConnection.connect(
+            DATABASE_URL, autocommit=True, row_factory=dict_row,
+            options=f'-c statement_timeout={AUTOCOMPLETE_BUDGET_MS}')
+        try:
+            yield conn
+        finally:
+            if conn.closed or conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+                await conn.close()
+            else:
+                _idle.append(conn)
+
+
+async def _close_all():
+    while _idle:
+        await _idle.pop().close()
+
+
+async def lookup(path, q):
+    rows, how = _cached(path, q)
+    if rows is not None:
+        return rows, how
+    async with _connection() as conn:
+        cur = await conn.execute(LOOKUPS[path][0], lookup_params(path, q))
+        rows = await cur.fetchall()
+    _remember(path, q, rows)
+    return rows, 'db'
+
+
+# ----------------------------------------------------------------------
+#  AUTH - the Flask-Login session cookie
+# ----------------------------------------------------------------------
+_serializer = None
+
+
+def session_user_id(headers):
+    global _serializer
+    if _serializer is None:
+        # imported here, not at the top - routes/case.py imports this module
+        from flask.sessions import SecureCookieSessionInterface
+        from app import app as flask_app
+        _serializer = (SecureCookieSessionInterface().get_signing_serializer(flask_app),
+                       flask_app.config['SESSION_COOKIE_NAME'],
+                       int(flask_app.permanent_session_lifetime.total_seconds()))
+    serializer, cookie_name, max_age = _serializer
+    cookies = SimpleCookie()
+    cookies.load(headers.get(b'cookie', b'').decode('latin-1'))
+    if cookie_name not in cookies:
+        return None
+    try:
+        return serializer.loads(cookies[cookie_name].value, max_age=max_age).get('_user_id')
+    except Exception:   # bad signature / expired / garbage
+        return None
+
+
+# ----------------------------------------------------------------------
+#  THE ASGI APP
+# ----------------------------------------------------------------------
+_inflight = {}   # (user id, tab, path) -> task for the lookup still running
+
+
+async def _respond(send, status, body, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'cache-control', b'no-store'), *headers]})
+    await send({'type': 'http.response.body', 'body': json.dumps(body, default=str).encode()})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _close_all()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    path = scope['path']
+    if path not in LOOKUPS or scope['method'] != 'GET':
+        return await _respond(send, 404, {'error': 'not found'})
+    user_id = session_user_id(dict(scope['headers']))
+    if not user_id:
+        return await _respond(send, 401, {'error': 'login required'})
+
+    args = parse_qs(scope['query_string'].decode('latin-1'))
+    q = (args.get('q', [''])[0]).strip().lower()
+    if not q:
+        return await _respond(send, 200, [])
+
+    started = time.perf_counter()
+    key = (user_id, args.get('tab', [''])[0], path)
+    task = asyncio.ensure_future(lookup(path, q))
+    superseded = _inflight.get(key)
+    _inflight[key] = task
+    if superseded is not None and not superseded.done():
+        superseded.cancel()
+    try:
+        rows, how = await asyncio.wait_for(task, AUTOCOMPLETE_BUDGET_MS / 1000)
+    except (asyncio.TimeoutError, psycopg.errors.QueryCanceled):
+        rows, how = None, 'timeout'
+    except asyncio.CancelledError:
+        if _inflight.get(key) is task:
+            raise   # we were cancelled ourselves (client gone / shutting down)
+        rows, how = None, 'superseded'
+    finally:
+        if _inflight.get(key) is task:
+            del _inflight[key]
+
+    timing = [(b'server-timing', f'{how};dur={(time.perf_counter() - started) * 1000:.1f}'.encode())]
+    if how == 'superseded':
+        return await _respond(send, 409, {'error': 'superseded by a newer search'}, timing)
+    if how == 'timeout':
+        return await _respond(send, 503, {'error': 'search took too long'}, timing)
+    await _respond(send, 200, rows, timing)
@@ -0,0 +1,139 @@
+# =============================================================================
+#  BALANCES - MONEY IS INTEGER PENCE, EVERYWHERE
+#  • money.amount_pence / vat_pence are BIGINT pence. Nothing does float
+#    arithmetic on money: Postgres sums bigints, Python sums ints - both exact.
+#  • signed_pence() is the ONE definition of what counts towards a balance:
+#    invoices, interest and recoverable charges go up, payments come off,
+#    non-recoverable charges don't count. Every balance query uses it,
+#    including aged_debt_mv in init_db.py.
+#  • to_pence() parses what users type; format_money() is the `money` Jinja
+#    filter; pounds() is the exact Decimal for JSON / spreadsheets
+#  • CaseTotals holds per-case totals in array('q') columns (8 bytes a value
+#    instead of a dict of Python objects per case) for reports and exports
+#  No Flask imports - init_db.py uses this too.
+# =============================================================================
+
+from array import array
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+TYPES = ('Invoice', 'Payment', 'Charge', 'Interest')
+TOTAL_COLUMNS = ('invoice', 'payment', 'charge', 'interest', 'balance')
+
+
+# ----------------------------------------------------------------------
+#  SQL FRAGMENTS
+# ----------------------------------------------------------------------
+def signed_pence(alias='m'):
+    """SQL: this money row's effect on the balance, in pence."""
+    return f"""CASE
+                   WHEN {alias}.type = 'Payment' THEN -{alias}.amount_pence
+                   WHEN {alias}.type IN ('Invoice', 'Interest') THEN {alias}.amount_pence
+                   WHEN {alias}.type = 'Charge' AND {alias}.recoverable = 1 THEN {alias}.amount_pence
+                   ELSE 0
+               END"""
+
+
+def totals_columns(alias='m'):
+    """SQL select list: invoice_pence, payment_pence, charge_pence, interest_pence, balance_pence.
+    Cast back to bigint - SUM(bigint) is numeric, which would come out as Decimal."""
+    cols = [f"COALESCE(SUM({alias}.amount_pence) FILTER (WHERE {alias}.type = '{t}'), 0)::bigint AS {t.lower()}_pence"
+            for t in TYPES]
+    cols.append(f"COALESCE(SUM({signed_pence(alias)}), 0)::bigint AS balance_pence")
+    return ",\n               ".join(cols)
+
+
+# ----------------------------------------------------------------------
+#  PARSING / FORMATTING
+# ----------------------------------------------------------------------
+def to_pence(value):
+    """'12.34', '£1,234.5', 12.34 -> pence as int (half-up). ValueError if it isn't an amount."""
+    if value is None or isinstance(value, bool):
+        raise ValueError("Not an amount")
+    try:
+        amount = Decimal(str(value).replace('£', '').replace(',', '').strip())
+    except InvalidOperation:
+        raise ValueError(f"Not an amount: {value!r}")
+    if not amount.is_finite():
+        raise ValueError(f"Not an amount: {value!r}")
+    return int((amount * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def pounds(pence):
+    """Exact pounds as a Decimal - 1234 -> Decimal('12.34')."""
+    return Decimal(int(pence or 0)).scaleb(-2)
+
+
+def format_money(pence):
+    """The `money` Jinja filter: pence -> '£1,234.56' (negatives as '£-1,234.56')."""
+    if pence is None or pence == '':
+        return "£0.00"
+    try:
+        pence = int(pence)
+    except (TypeError, ValueError):
+        return str(pence)
+    sign = '-' if pence < 0 else ''
+    whole, part = divmod(abs(pence), 100)
+    return f"£{sign}{whole:,}.{part:02d}"
+
+
+# ----------------------------------------------------------------------
+#  PER-CASE TOTALS
+# ----------------------------------------------------------------------
+class CaseTotals:
+    """Totals per case in pence, one array('q') per column, in case id order."""
+
+    def __init__(self):
+        self.case_ids = array('q')
+        self.debtors = []
+        self.columns = {name: array('q') for name in TOTAL_COLUMNS}
+
+    def __len__(self):
+        return len(self.case_ids)
+
+    def append(self, row):
+        self.case_ids.append(row['case_id'])
+        self.debtors.append(row['debtor'])
+        for name in TOTAL_COLUMNS:
+            self.columns[name].append(row[f'{name}_pence'])
+
+    def rows(self):
+        for i, case_id in enumerate(self.case_ids):
+            yield {'case_id': case_id, 'debtor': self.debtors[i],
+                   **{name: self.columns[name][i] for name in TOTAL_COLUMNS}}
+
+    def grand(self):
+        return {name: sum(self.columns[name]) for name in TOTAL_COLUMNS}
+
+
+def load_case_totals(db, money_source, where, params):
+    """Totals for every case matching `where` (on cases s), read from money_source
+    (money or money_all - see archive.source). One GROUP BY, streamed into arrays."""
+    totals = CaseTotals()
+    c = db.cursor()
+    c.execute(f"""
+        SELECT s.id AS case_id,
+               COALESCE(NULLIF(s.debtor_business_name, ''), s.debtor_first || ' ' || s.debtor_last) AS debtor,
+               {totals_columns('m')}
+        FROM cases s
+        LEFT JOIN {money_source} m ON m.case_id = s.id
+        WHERE {where}
+        GROUP BY s.id
+        ORDER BY s.id
+    """, params)
+    for row in c:
+        totals.append(row)
+    return totals
+
+
+def case_balances(db, money_source, case_ids):
+    """{case_id: balance in pence} for these cases, in one query. Cases with no money are 0."""
+    c = db.cursor()
+    c.execute(f"""
+        SELECT m.case_id, COALESCE(SUM({signed_pence('m')}), 0)::bigint AS balance_pence
+        FROM {money_source} m
+        WHERE m.case_id = ANY(%s)
+        GROUP BY m.case_id
+    """, (list(case_ids),))
+    balances = {case_id: 0 for case_id in case_ids}
+    balances.update({r['case_id']: r['balance_pence'] for r in c.fetchall()})
+    return balances
@@ -0,0 +1,61 @@
+# =============================================================================
+#  LOGIN BURST BENCHMARK
+#  Fires a burst of concurrent logins at a running server (shift start) and
+#  prints latency percentiles and the status codes that came back.
+#  With the site-wide 'login' slots (LOGIN_SLOTS, load_limits.py) the slow
+#  tail is replaced by quick 503 answers rather than every worker sitting
+#  on bcrypt. Only failed logins count towards the IP / username throttles,
+#  so a burst of good logins from one IP never gets 429s.
+#
+#  python benchmarks/login_burst.py http://localhost:8000 --user admin --password ... [--requests 200 --concurrency 50]
+# =============================================================================
+
+import argparse
+import statistics
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def attempt(url, username, password):
+    body = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+    opener = urllib.request.build_opener(_NoRedirect)
+    start = time.perf_counter()
+    try:
+        status = opener.open(url, data=body, timeout=30).status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - start, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login burst benchmark')
+    parser.add_argument('base_url')
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    url = args.base_url.rstrip('/') + '/login'
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda _: attempt(url, args.user, args.password), range(args.requests)))
+
+    times = sorted(t for t, _ in results)
+    pct = lambda p: times[min(len(times) - 1, int(len(times) * p))] * 1000
+    print(f"{len(times)} logins, {args.concurrency} at a time")
+    print(f"p50 {pct(0.50):.0f} ms   p95 {pct(0.95):.0f} ms   p99 {pct(0.99):.0f} ms   "
+          f"mean {statistics.mean(times) * 1000:.0f} ms")
+    print("status codes:", dict(Counter(s for _, s in results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# =============================================================================
+#  WORKER BOOT BENCHMARK
+#  Measures what one gunicorn worker pays to import the app:
+#    • lazy  - the app as it ships (pandas / WeasyPrint imported on first export)
+#    • eager - the app plus the reporting stack imported up front (the old way)
+#  Each run is a fresh Python process, so the numbers are what a cold worker sees.
+#
+#  python benchmarks/worker_boot.py [--runs 5] [--workers 9]
+# =============================================================================
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import app
+if {eager}:
+    import pandas, weasyprint
+elapsed = time.perf_counter() - start
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': elapsed, 'rss_mb': rss_kb / 1024}}))
+"""
+
+
+def measure(eager, runs):
+    env = dict(os.environ)
+    # Importing the app never connects, but extensions.py needs the variable set
+    env.setdefault('DATABASE_URL', 'postgresql://localhost/harbour_bench')
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', CHILD.format(root=ROOT, eager=eager)],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        'seconds': statistics.median(s['seconds'] for s in samples),
+        'rss_mb': statistics.median(s['rss_mb'] for s in samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker boot time / memory benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=9, help='Worker count to project the saving for.')
+    args = parser.parse_args()
+
+    lazy = measure(False, args.runs)
+    eager = measure(True, args.runs)
+
+    print(f"{'':8}{'import (s)':>12}{'peak RSS (MB)':>16}")
+    print(f"{'lazy':8}{lazy['seconds']:>12.3f}{lazy['rss_mb']:>16.1f}")
+    print(f"{'eager':8}{eager['seconds']:>12.3f}{eager['rss_mb']:>16.1f}")
+    saved_s = eager['seconds'] - lazy['seconds']
+    saved_mb = eager['rss_mb'] - lazy['rss_mb']
+    print(f"\nPer worker: {saved_s:.3f}s faster boot, {saved_mb:.1f} MB less memory")
+    print(f"Across {args.workers} workers: {saved_mb * args.workers:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# =============================================================================
+#  DB HEALTH - SIZES, BLOAT AND INDEX USE FROM THE POSTGRES CATALOGS
+#  • ONE query reads every table's columns, sizes, row estimate, dead rows,
+#    scan counts and indexes (as JSON) - /db_structure used to run one
+#    information_schema query per table on every view
+#  • The result is cached per worker for DB_HEALTH_CACHE_SECONDS; the page
+#    has a refresh link
+#  • Flags worked out from it:
+#      bloat   - dead rows over DB_HEALTH_BLOAT_RATIO of the table
+#      unused  - indexes never scanned since the stats were reset
+#                (primary keys / unique ones are needed anyway, not listed)
+#      missing - foreign keys with no index starting with their column, and
+#                big tables read mostly by sequential scan
+#  • Top statements come from pg_stat_statements if the extension is
+#    installed - read in a savepoint so a missing/unloaded one just hides them
+#  Shown at /admin/db_health (routes/admin.py)
+# =============================================================================
+
+import os
+import threading
+import time
+from datetime import datetime
+import psycopg
+
+DB_HEALTH_CACHE_SECONDS = int(os.environ.get('DB_HEALTH_CACHE_SECONDS', 60))
+DB_HEALTH_BLOAT_RATIO = float(os.environ.get('DB_HEALTH_BLOAT_RATIO', 0.2))
+DB_HEALTH_SEQ_SCAN_ROWS = int(os.environ.get('DB_HEALTH_SEQ_SCAN_ROWS', 10000))
+DB_HEALTH_TOP_STATEMENTS = int(os.environ.get('DB_HEALTH_TOP_STATEMENTS', 20))
+
+_cache = {'expires': 0, 'data': None}
+_lock = threading.Lock()
+
+INTROSPECT_SQL = """
+    WITH rels AS (
+        SELECT c.oid, c.relname, c.relkind,
+               GREATEST(c.reltuples, 0)::bigint AS est_rows,
+               pg_table_size(c.oid) AS table_bytes,
+               pg_indexes_size(c.oid) AS index_bytes,
+               pg_total_relation_size(c.oid) AS total_bytes,
+               COALESCE(s.seq_scan, 0) AS seq_scan,
+               COALESCE(s.seq_tup_read, 0) AS seq_tup_read,
+               COALESCE(s.idx_scan, 0) AS idx_scan,
+               COALESCE(s.n_live_tup, 0) AS live_rows,
+               COALESCE(s.n_dead_tup, 0) AS dead_rows,
+               to_char(GREATEST(s.last_vacuum, s.last_autovacuum), 'DD/MM/YYYY HH24:MI') AS last_vacuum,
+               to_char(GREATEST(s.last_analyze, s.last_autoanalyze), 'DD/MM/YYYY HH24:MI') AS last_analyze
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'm')
+    ),
+    cols AS (
+        SELECT a.attrelid,
+               json_agg(json_build_object(
+                   'column_name', a.attname,
+                   'data_type', format_type(a.atttypid, a.atttypmod),
+                   'is_nullable', CASE WHEN a.attnotnull THEN 'NO' ELSE 'YES' END,
+                   'column_default', pg_get_expr(d.adbin, d.adrelid)
+               ) ORDER BY a.attnum) AS columns
+        FROM pg_attribute a
+        LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE a.attrelid IN (SELECT oid FROM rels) AND a.attnum > 0 AND NOT a.attisdropped
+        GROUP BY a.attrelid
+    ),
+    idx AS (
+        SELECT i.indrelid,
+               json_agg(json_build_object(
+                   'name', ic.relname,
+                   'bytes', pg_relation_size(i.indexrelid),
+                   'scans', COALESCE(si.idx_scan, 0),
+                   'unique', i.indisunique,
+                   'primary', i.indisprimary,
+                   'definition', pg_get_indexdef(i.indexrelid)
+               ) ORDER BY ic.relname) AS indexes
+        FROM pg_index i
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        LEFT JOIN pg_stat_user_indexes si ON si.indexrelid = i.indexrelid
+        WHERE i.indrelid IN (SELECT oid FROM rels)
+        GROUP BY i.indrelid
+    ),
+    fks AS (
+        SELECT con.conrelid,
+               json_agg(json_build_object(
+                   'name', con.conname,
+                   'column', a.attname,
+                   'references', con.confrelid::regclass::text
+               ) ORDER BY con.conname) AS unindexed_fks
+        FROM pg_constraint con
+        JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = con.conkey[1]
+        WHERE con.contype = 'f' AND con.conrelid IN (SELECT oid FROM rels)
+          AND NOT EXISTS (SELECT 1 FROM pg_index i
+                          WHERE i.indrelid = con.conrelid AND i.indkey[0] = con.conkey[1])
+        GROUP BY con.conrelid
+    )
+    SELECT json_build_object(
+        'server_version', current_setting('server_version'),
+        'database_bytes', pg_database_size(current_database()),
+        'stats_reset', (SELECT to_char(stats_reset, 'DD/MM/YYYY HH24:MI')
+                        FROM pg_stat_database WHERE datname = current_database()),
+        'has_pg_stat_statements', EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'),
+        'tables', COALESCE((
+            SELECT json_agg(json_build_object(
+                       'name', r.relname,
+                       'kind', CASE r.relkind WHEN 'v' THEN 'view' WHEN 'm' THEN 'materialized view' ELSE 'table' END,
+                       'est_rows', r.est_rows, 'live_rows', r.live_rows, 'dead_rows', r.dead_rows,
+                       'table_bytes', r.table_bytes, 'index_bytes', r.index_bytes, 'total_bytes', r.total_bytes,
+                       'seq_scan', r.seq_scan, 'seq_tup_read', r.seq_tup_read, 'idx_scan', r.idx_scan,
+                       'last_vacuum', r.last_vacuum, 'last_analyze', r.last_analyze,
+                       'columns', COALESCE(cols.columns, '[]'),
+                       'indexes', COALESCE(idx.indexes, '[]'),
+                       'unindexed_fks', COALESCE(fks.unindexed_fks, '[]')
+                   ) ORDER BY r.relname)
+            FROM rels r
+            LEFT JOIN cols ON cols.attrelid = r.oid
+            LEFT JOIN idx ON idx.indrelid = r.oid
+            LEFT JOIN fks ON fks.conrelid = r.oid
+        ), '[]')
+    ) AS health
+"""
+
+STATEMENTS_SQL = """
+    SELECT query, calls, total_exec_time AS total_ms, mean_exec_time AS mean_ms, rows,
+           shared_blks_hit, shared_blks_read
+    FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+    ORDER BY total_exec_time DESC
+    LIMIT %s
+"""
+
+
+def top_statements(db, limit=DB_HEALTH_TOP_STATEMENTS):
+    """(rows, error) - rows is None if pg_stat_statements can't be read."""
+    try:
+        with db.transaction():
+            c = db.cursor()
+            c.execute(STATEMENTS_SQL, (limit,))
+            return c.fetchall(), None
+    except psycopg.Error as e:
+        return None, str(e).strip().splitlines()[0]
+
+
+def _flags(tables):
+    bloated, unused, missing = [], [], []
+    for t in tables:
+        if t['kind'] == 'view':
+            continue
+        rows = t['live_rows'] + t['dead_rows']
+        t['dead_ratio'] = t['dead_rows'] / rows if rows else 0
+        if t['dead_ratio'] > DB_HEALTH_BLOAT_RATIO and t['dead_rows'] >= 1000:
+            bloated.append(t)
+        for i in t['indexes']:
+            if i['scans'] == 0 and not (i['unique'] or i['primary']):
+                unused.append(dict(i, table=t['name']))
+        for fk in t['unindexed_fks']:
+            missing.append({'table': t['name'], 'reason': f"foreign key {fk['column']} → {fk['references']} has no index"})
+        if t['est_rows'] >= DB_HEALTH_SEQ_SCAN_ROWS and t['seq_scan'] > t['idx_scan']:
+            avg = t['seq_tup_read'] // t['seq_scan'] if t['seq_scan'] else 0
+            missing.append({'table': t['name'], 'reason': f"{t['seq_scan']:,} sequential scans (avg {avg:,} rows read) "
+                                                          f"vs {t['idx_scan']:,} index scans"})
+    bloated.sort(key=lambda t: t['dead_rows'], reverse=True)
+    unused.sort(key=lambda i: i['bytes'], reverse=True)
+    return bloated, unused, missing
+
+
+def introspect(db):
+    c = db.cursor()
+    c.execute(INTROSPECT_SQL)
+    health = c.fetchone()['health']
+    health['bloated'], health['unused_indexes'], health['missing_indexes'] = _flags(health['tables'])
+    health['statements'], health['statements_error'] = (
+        top_statements(db) if health['has_pg_stat_statements'] else (None, None))
+    health['checked_at'] = datetime.now()
+    return health
+
+
+def db_health(db, refresh=False):
+    """introspect(), cached per worker for DB_HEALTH_CACHE_SECONDS."""
+    with _lock:
+        if not refresh and _cache['data'] is not None and time.time() < _cache['expires']:
+            return _cache['data']
+    data = introspect(db)
+    db.commit()
+    with _lock:
+        _cache['data'] = data
+        _cache['expires'] = time.time() + DB_HEALTH_CACHE_SECONDS
+    return data
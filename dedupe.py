@@ -0,0 +1,201 @@
+# =============================================================================
+#  DEDUPE - SPOTTING THE SAME DEBTOR OPENED TWICE UNDER ONE CLIENT
+#  • Every case gets a few "blocking keys" in debtor_keys: normalised email,
+#    phone, postcode and debtor name. Two cases are only ever compared if they
+#    share a key under the same client, so nothing is compared pairwise.
+#  • The normalising is done in ONE place - KEYS_SQL - and used for new cases,
+#    for checking form values before a case exists, and for the batch rebuild.
+#  • Scoring: shared email or phone = 3, name = 2, postcode = 1.
+#    DUPLICATE_THRESHOLD (3) means email, phone or name + postcode.
+#  CLI:  flask --app app dedupe rebuild      (re-index every case)
+#        flask --app app dedupe report       (CSV of duplicate clusters)
+# =============================================================================
+
+import csv
+import os
+import sys
+import click
+from flask.cli import AppGroup
+from extensions import get_db
+
+KEY_WEIGHTS = {'email': 3, 'phone': 3, 'name': 2, 'postcode': 1}
+DUPLICATE_THRESHOLD = int(os.environ.get('DUPLICATE_THRESHOLD', 3))
+# Keys shared by more cases than this (a big block of flats on one postcode,
+# "accounts@") say nothing useful and would make the batch self-join quadratic
+MAX_BLOCK_SIZE = int(os.environ.get('DEDUPE_MAX_BLOCK_SIZE', 50))
+REBUILD_CHUNK = int(os.environ.get('DEDUPE_REBUILD_CHUNK', 50000))
+
+# {source} must provide: id, client_id, debtor_business_name, debtor_first,
+# debtor_last, phone, email, postcode
+KEYS_SQL = r"""
+    SELECT s.id AS case_id, s.client_id, k.key_type, k.key_value
+    FROM {source} s
+    CROSS JOIN LATERAL (VALUES
+        ('email', NULLIF(lower(trim(COALESCE(s.email, ''))), '')),
+        ('phone', (SELECT CASE WHEN length(p) >= 7 THEN p END
+                   FROM regexp_replace(regexp_replace(COALESCE(s.phone, ''), '\D', '', 'g'), '^44', '0') AS p)),
+        ('postcode', NULLIF(upper(regexp_replace(COALESCE(s.postcode, ''), '[^A-Za-z0-9]', '', 'g')), '')),
+        ('name', NULLIF(regexp_replace(
+                    regexp_replace(lower(COALESCE(NULLIF(s.debtor_business_name, ''),
+                                                  COALESCE(s.debtor_first, '') || ' ' || COALESCE(s.debtor_last, ''))),
+                                   '\m(ltd|limited|plc|llp)\M', '', 'g'),
+                    '[^a-z0-9]', '', 'g'), ''))
+    ) AS k(key_type, key_value)
+    WHERE k.key_value IS NOT NULL
+"""
+
+CASE_COLUMNS = "id, client_id, debtor_business_name, debtor_first, debtor_last, phone, email, postcode"
+
+
+def index_cases(db, case_ids):
+    """(Re)build the keys for these cases - call after inserting or importing cases (caller commits)."""
+    c = db.cursor()
+    c.execute("DELETE FROM debtor_keys WHERE case_id = ANY(%s)", (list(case_ids),))
+    c.execute(f"""
+        INSERT INTO debtor_keys (case_id, client_id, key_type, key_value)
+        {KEYS_SQL.format(source=f'(SELECT {CASE_COLUMNS} FROM cases WHERE id = ANY(%s))')}
+        ON CONFLICT DO NOTHING
+    """, (list(case_ids),))
+
+
+def _score(rows):
+    matches = []
+    for r in rows:
+        score = sum(KEY_WEIGHTS[t] for t in r['key_types'])
+        if score >= DUPLICATE_THRESHOLD:
+            matches.append({'case_id': r['case_id'], 'debtor_name': r['debtor_name'],
+                            'status': r['status'], 'matched_on': sorted(r['key_types']), 'score': score})
+    return sorted(matches, key=lambda m: (-m['score'], m['case_id']))
+
+
+_MATCH_SQL = """
+    WITH probe AS ({probe})
+    SELECT k.case_id, array_agg(DISTINCT k.key_type) AS key_types,
+           COALESCE(NULLIF(s.debtor_business_name, ''), s.debtor_first || ' ' || s.debtor_last) AS debtor_name,
+           s.status
+    FROM probe p
+    JOIN debtor_keys k
+      ON k.client_id = p.client_id AND k.key_type = p.key_type AND k.key_value = p.key_value
+    JOIN cases s ON s.id = k.case_id
+    WHERE k.case_id IS DISTINCT FROM p.case_id
+    GROUP BY k.case_id, s.debtor_business_name, s.debtor_first, s.debtor_last, s.status
+"""
+
+
+def find_duplicates_of_case(db, case_id):
+    """Likely duplicates of an existing (already indexed) case."""
+    c = db.cursor()
+    c.execute(_MATCH_SQL.format(probe="SELECT case_id, client_id, key_type, key_value FROM debtor_keys WHERE case_id = %s"),
+              (case_id,))
+    return _score(c.fetchall())
+
+
+def find_duplicates_of_values(db, client_id, debtor_business_name='', debtor_first='', debtor_last='',
+                              phone='', email='', postcode=''):
+    """Likely duplicates of a case that hasn't been saved yet (the Add Case form)."""
+    source = ("(SELECT NULL::int AS id, %s::int AS client_id, %s::text AS debtor_business_name, "
+              "%s::text AS debtor_first, %s::text AS debtor_last, %s::text AS phone, %s::text AS email, "
+              "%s::text AS postcode)")
+    c = db.cursor()
+    c.execute(_MATCH_SQL.format(probe=KEYS_SQL.format(source=source)),
+              (client_id, debtor_business_name, debtor_first, debtor_last, phone, email, postcode))
+    return _score(c.fetchall())
+
+
+# ----------------------------------------------------------------------
+#  BATCH
+# ----------------------------------------------------------------------
+def rebuild_index(db, log=print):
+    """Re-key every case, one id range per transaction."""
+    c = db.cursor()
+    c.execute("SELECT COALESCE(MIN(id), 0) AS lo, COALESCE(MAX(id), 0) AS hi FROM cases")
+    bounds = c.fetchone()
+    c.execute("TRUNCATE debtor_keys")
+    db.commit()
+    for start in range(bounds['lo'], bounds['hi'] + 1, REBUILD_CHUNK):
+        c.execute(f"""
+            INSERT INTO debtor_keys (case_id, client_id, key_type, key_value)
+            {KEYS_SQL.format(source=f'(SELECT {CASE_COLUMNS} FROM cases WHERE id >= %s AND id < %s)')}
+            ON CONFLICT DO NOTHING
+        """, (start, start + REBUILD_CHUNK))
+        db.commit()
+        log(f"cases {start}-{start + REBUILD_CHUNK - 1}: {c.rowcount} keys")
+
+
+def duplicate_pairs(db, client_id=None):
+    """Yield (case_a, case_b, score) for every likely duplicate pair.
+    Self-join inside each (client, key) block only; streamed with a server-side cursor."""
+    with db.cursor(name='dedupe_pairs') as c:
+        c.execute("""
+            WITH blocks AS (
+                SELECT client_id, key_type, key_value
+                FROM debtor_keys
+                WHERE %(client_id)s::int IS NULL OR client_id = %(client_id)s::int
+                GROUP BY client_id, key_type, key_value
+                HAVING COUNT(*) BETWEEN 2 AND %(max_block)s
+            ),
+            pairs AS (
+                SELECT a.case_id AS case_a, b.case_id AS case_b, a.key_type
+                FROM blocks bl
+                JOIN debtor_keys a USING (client_id, key_type, key_value)
+                JOIN debtor_keys b USING (client_id, key_type, key_value)
+                WHERE a.case_id < b.case_id
+            )
+            SELECT case_a, case_b,
+                   SUM(CASE key_type WHEN 'email' THEN %(w_email)s WHEN 'phone' THEN %(w_phone)s
+                                     WHEN 'name' THEN %(w_name)s ELSE %(w_postcode)s END) AS score
+            FROM (SELECT DISTINCT case_a, case_b, key_type FROM pairs) p
+            GROUP BY case_a, case_b
+            HAVING SUM(CASE key_type WHEN 'email' THEN %(w_email)s WHEN 'phone' THEN %(w_phone)s
+                                     WHEN 'name' THEN %(w_name)s ELSE %(w_postcode)s END) >= %(threshold)s
+            ORDER BY case_a, case_b
+        """, {'client_id': client_id, 'max_block': MAX_BLOCK_SIZE, 'threshold': DUPLICATE_THRESHOLD,
+              **{f'w_{k}': v for k, v in KEY_WEIGHTS.items()}})
+        for row in c:
+            yield row['case_a'], row['case_b'], row['score']
+
+
+def duplicate_clusters(db, client_id=None):
+    """Group the pairs into clusters (union-find) - {lowest case id: [case ids]}."""
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b, _ in duplicate_pairs(db, client_id):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    clusters = {}
+    for case_id in parent:
+        clusters.setdefault(find(case_id), []).append(case_id)
+    return {root: sorted(ids) for root, ids in clusters.items()}
+
+
+# =============================================================================
+#  CLI - registered in app.py
+# =============================================================================
+
+dedupe_cli = AppGroup('dedupe', help='Duplicate debtor detection.')
+
+
+@dedupe_cli.command('rebuild')
+def dedupe_rebuild():
+    rebuild_index(get_db(), log=click.echo)
+
+
+@dedupe_cli.command('report')
+@click.option('--client', 'client_id', type=int, default=None)
+def dedupe_report(client_id):
+    out = csv.writer(sys.stdout)
+    out.writerow(['cluster', 'case_id'])
+    clusters = duplicate_clusters(get_db(), client_id)
+    for root, ids in sorted(clusters.items()):
+        for case_id in ids:
+            out.writerow([root, case_id])
+    click.echo(f"{len(clusters)} clusters", err=True)
@@ -1,22 +1,63 @@
 # =============================================================================
 #  EXTENSIONS - SHARED STUFF USED BY THE WHOLE APP
 #  • Database connection (get_db / close_db)
-#  • Jinja filters: money formatting and date formatting
+#  • Each request's connection gets a statement_timeout - the route's
+#    @query_budget or STATEMENT_TIMEOUT_MS (see load_limits.py)
+#  • TimedCursor - logs each query's SQL and timing into g.query_log while a
+#    request is being profiled (profiler.py); costs nothing otherwise
+#  • Jinja filters: money formatting (pence, see balances.py) and date formatting
 #  • Imported in app.py and used everywhere
 #  DO NOT TOUCH unless you know what you're doing
 # =============================================================================
 
 import os
-from flask import g
+import time
+from flask import g, has_app_context, has_request_context, current_app, request
 import psycopg
+from psycopg import sql
 from psycopg.rows import dict_row
 from datetime import datetime
+from balances import format_money
 
 DATABASE_URL = os.environ['DATABASE_URL']
+# default query budget for a web request; heavy routes raise it with @query_budget
+STATEMENT_TIMEOUT_MS = int(os.environ.get('STATEMENT_TIMEOUT_MS', 5000))
+
+
+class TimedCursor(psycopg.Cursor):
+    # g.query_log is only set on requests the profiler picked
+    def _timed(self, run, query):
+        log = g.get('query_log') if has_app_context() else None
+        if log is None:
+            return run()
+        start = time.perf_counter()
+        try:
+            return run()
+        finally:
+            log.append({
+                'sql': query.as_string(self) if isinstance(query, sql.Composable) else str(query),
+                'start': start,
+                'ms': (time.perf_counter() - start) * 1000,
+                'rows': self.rowcount,
+            })
+
+    def execute(self, query, params=None, **kwargs):
+        return self._timed(lambda: super(TimedCursor, self).execute(query, params, **kwargs), query)
+
+    def executemany(self, query, params_seq, **kwargs):
+        return self._timed(lambda: super(TimedCursor, self).executemany(query, params_seq, **kwargs), query)
+
+
+def statement_timeout_for_request():
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'statement_timeout_ms', STATEMENT_TIMEOUT_MS)
+
 
 def get_db():
     if 'db' not in g:
-        g.db = psycopg.connect(DATABASE_URL, row_factory=dict_row)
+        # set at connect time - no extra round trip. CLI jobs (no request) get no limit.
+        options = f'-c statement_timeout={statement_timeout_for_request()}' if has_request_context() else ''
+        g.db = psycopg.connect(DATABASE_URL, row_factory=dict_row, cursor_factory=TimedCursor, options=options)
     return g.db
 
 def close_db(e=None):
@@ -28,13 +69,9 @@ def close_db(e=None):
 #  JINJA FILTERS - USED IN TEMPLATES FOR £ AND DATES
 # =============================================================================
 
-def money(value):
-    if value is None or value == '':
-        return "£0.00"
-    try:
-        return f"£{float(value):,.2f}"
-    except (TypeError, ValueError):
-        return str(value)
+# Amounts are integer pence - the formatting lives in balances.py with the
+# rest of the money code
+money = format_money
 
 def format_date(date_obj):
     if not date_obj:
@@ -0,0 +1,112 @@
+# =============================================================================
+#  FRAGMENT CACHE - CACHES PIECES OF RENDERED TEMPLATES
+#  • In a template:
+#        {% call fragment('recent_cases', ttl=300) %} ...html... {% endcall %}
+#        {% call fragment('client_cases', client.id) %} ... {% endcall %}
+#    Keep per-request bits (the selected row etc.) outside the cached block -
+#    a variant per request multiplies the cache by the number of requests.
+#  • Every fragment belongs to a version name ('recent_cases', 'client_cases:12').
+#    Writes call bump(db, ...) in the same transaction, which moves the version
+#    on and makes every worker re-render that fragment next time.
+#  • Versions live in the fragment_versions table (so all gunicorn workers see
+#    them); the rendered HTML lives in each worker's memory, LRU + TTL.
+#  • Pass data to cached sections as LazyRows so the query only runs when the
+#    fragment actually has to be rendered.
+# =============================================================================
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from flask import g
+from markupsafe import Markup
+from extensions import get_db
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 2000))
+FRAGMENT_DEFAULT_TTL = int(os.environ.get('FRAGMENT_DEFAULT_TTL', 300))
+
+_store = OrderedDict()   # (version_name, version, variant) -> (expires_at, html)
+_lock = threading.Lock()
+
+
+def version_name(name, scope=None):
+    return f"{name}:{scope}" if scope is not None else name
+
+
+# ----------------------------------------------------------------------
+#  VERSIONS
+# ----------------------------------------------------------------------
+def load_versions(names):
+    """Fetch the versions a page is about to use in one query (cached on g for the request)."""
+    versions = g.setdefault('fragment_versions', {})
+    missing = [n for n in names if n not in versions]
+    if missing:
+        c = get_db().cursor()
+        c.execute("SELECT name, version FROM fragment_versions WHERE name = ANY(%s)", (missing,))
+        found = {r['name']: r['version'] for r in c.fetchall()}
+        for n in missing:
+            versions[n] = found.get(n, 0)
+    return versions
+
+
+def bump(db, *names):
+    """Invalidate fragments after a write. Runs on the caller's connection - caller commits."""
+    if not names:
+        return
+    c = db.cursor()
+    c.execute("""
+        INSERT INTO fragment_versions (name, version)
+        SELECT unnest(%s::text[]), 1
+        ON CONFLICT (name) DO UPDATE SET version = fragment_versions.version + 1
+    """, (sorted(set(names)),))
+
+
+# ----------------------------------------------------------------------
+#  THE JINJA HELPER - registered as a global in app.py
+# ----------------------------------------------------------------------
+def fragment(name, scope=None, variant=None, ttl=FRAGMENT_DEFAULT_TTL, caller=None):
+    vname = version_name(name, scope)
+    version = load_versions([vname])[vname]
+    key = (vname, version, variant)
+    now = time.monotonic()
+
+    with _lock:
+        hit = _store.get(key)
+        if hit and hit[0] > now:
+            _store.move_to_end(key)
+            return Markup(hit[1])
+
+    html = caller()
+
+    with _lock:
+        _store[key] = (now + ttl, str(html))
+        _store.move_to_end(key)
+        while len(_store) > FRAGMENT_CACHE_SIZE:
+            _store.popitem(last=False)
+    return Markup(html)
+
+
+class LazyRows:
+    """A query result that is only fetched if a template actually iterates it."""
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._rows = None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = self._fetch()
+        return self._rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
@@ -0,0 +1,41 @@
+# =============================================================================
+#  GUNICORN CONFIG - picked up automatically by:   gunicorn app:app
+#  • preload_app: the app (Flask, psycopg, all routes) is imported ONCE in the
+#    master and shared copy-on-write with every worker instead of each worker
+#    importing it again
+#  • No DB connection is ever opened in the master - get_db() connects lazily
+#    inside a request, so nothing is shared across the fork
+#  • pandas / WeasyPrint are NOT imported at start-up (see routes/reports.py).
+#    Set PRELOAD_REPORTS=1 to import them in the master instead, so the few
+#    workers that export share one copy rather than each loading their own.
+#  • Dedicated report workers: run a second gunicorn (e.g. -b :8001 with
+#    PRELOAD_REPORTS=1) and point /report, /export_* at it in the proxy
+#    (deploy/nginx.conf).
+#  benchmarks/worker_boot.py shows the start-up time / memory difference.
+#  • Workers are sync - one request each, no threads - so anything that has
+#    to be limited across requests (bcrypt logins, reports, exports) is
+#    limited in Postgres with advisory-lock slots (load_limits.py), never
+#    with a per-process semaphore. The proxy must set X-Forwarded-For
+#    (TRUSTED_PROXIES in app.py).
+# =============================================================================
+
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+
+def on_starting(server):
+    if os.environ.get('PRELOAD_REPORTS') == '1':
+        import pandas  # noqa: F401
+        import weasyprint  # noqa: F401
+
+
+def when_ready(server):
+    # Everything imported so far lives in the master. Freezing it stops the
+    # garbage collector touching those objects in the workers, which would
+    # otherwise copy the shared pages one by one.
+    gc.freeze()
@@ -0,0 +1,142 @@
+# =============================================================================
+#  HASHING - PASSWORD CHECKS WITH A TIME LIMIT, AND LOGIN THROTTLES
+#  • bcrypt runs on a small thread pool (bcrypt releases the GIL while it
+#    hashes) so a check that takes longer than HASH_TIMEOUT_SECONDS is given
+#    up on with HashingBusy instead of holding the worker
+#  • How many checks run at once is limited site-wide, not here: login takes
+#    a 'login' slot in load_limits.py (Postgres advisory locks, shared by every
+#    gunicorn worker) before it hashes, and is refused with 503 when none is
+#    free. The workers are sync - one request each - so a per-process limit
+#    could never fill. A check that times out can't be stopped (bcrypt is
+#    one C call), so HashingBusy carries its future and login keeps the slot
+#    until that hash has really finished - a timeout never frees a core early.
+#  • check_unknown_user() runs the same bcrypt work against a dummy hash, so
+#    a name that doesn't exist takes as long to reject as a wrong password
+#  • Sliding-window throttles for failed logins per username and per client IP
+#    (the real client IP - app.py trusts the proxy's X-Forwarded-For)
+#  • needs_rehash() spots hashes made with an old BCRYPT_ROUNDS so login can
+#    upgrade them transparently
+#  The pool is created on first use, i.e. inside the worker after the fork,
+#  never in the gunicorn master (see gunicorn.conf.py).
+#  The throttles are in memory, per worker process.
+# =============================================================================
+
+import os
+import time
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+HASH_TIMEOUT_SECONDS = float(os.environ.get('HASH_TIMEOUT_SECONDS', 5))
+
+
+class HashingBusy(Exception):
+    """A password check ran out of time - caller should answer 503.
+    .future is the hash, which is still running."""
+
+    def __init__(self, future):
+        super().__init__('password hashing timed out')
+        self.future = future
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_dummy_hash = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='bcrypt')
+    return _executor
+
+
+def _run(fn, *args):
+    future = _get_executor().submit(fn, *args)
+    try:
+        return future.result(timeout=HASH_TIMEOUT_SECONDS)
+    except FutureTimeout:
+        future.cancel()   # only helps if it hasn't started
+        raise HashingBusy(future)
+
+
+def check_password(password, password_hash):
+    return _run(bcrypt.checkpw, password.encode(), bytes(password_hash))
+
+
+def check_unknown_user(password):
+    """Same cost as check_password() for a username that doesn't exist. Always False."""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = bcrypt.hashpw(os.urandom(16), bcrypt.gensalt(BCRYPT_ROUNDS))
+    _run(bcrypt.checkpw, password.encode(), _dummy_hash)
+    return False
+
+
+def hash_password(password, rounds=BCRYPT_ROUNDS):
+    return _run(lambda: bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)))
+
+
+def needs_rehash(password_hash, rounds=BCRYPT_ROUNDS):
+    # bcrypt hashes look like $2b$12$<salt+hash> - the 12 is the cost
+    try:
+        return int(bytes(password_hash)[4:6]) != rounds
+    except ValueError:
+        return True
+
+
+# ----------------------------------------------------------------------
+#  THROTTLING
+# ----------------------------------------------------------------------
+class SlidingWindow:
+    """At most `limit` hits per `window` seconds for each key. In memory, per process."""
+
+    def __init__(self, limit, window, max_keys=50000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._hits = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def _prune(self, hits, now):
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+
+    def retry_after(self, key):
+        """Seconds until `key` may try again, 0 if it isn't blocked."""
+        now = time.monotonic()
+        with self._lock:
+            hits = self._hits.get(key)
+            if not hits:
+                return 0
+            self._prune(hits, now)
+            if len(hits) < self.limit:
+                return 0
+            return int(hits[0] + self.window - now) + 1
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._hits and len(self._hits) >= self.max_keys:
+                # drop keys whose window has fully expired so memory stays bounded
+                for k in [k for k, h in self._hits.items() if not h or h[-1] <= now - self.window]:
+                    del self._hits[k]
+            hits = self._hits[key]
+            self._prune(hits, now)
+            hits.append(now)
+
+    def clear(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+
+# failed logins per username / per client IP - a successful login never counts
+user_throttle = SlidingWindow(int(os.environ.get('LOGIN_MAX_FAILURES', 5)),
+                              int(os.environ.get('LOGIN_FAILURE_WINDOW', 300)))
+ip_throttle = SlidingWindow(int(os.environ.get('LOGIN_MAX_PER_IP', 30)),
+                            int(os.environ.get('LOGIN_IP_WINDOW', 300)))
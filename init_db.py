@@ -1,5 +1,6 @@
 # init_db.py
 import psycopg
+from balances import signed_pence
 
 def init_db(DATABASE_URL):
     conn = psycopg.connect(DATABASE_URL)
@@ -49,13 +50,13 @@ def init_db(DATABASE_URL):
         id SERIAL PRIMARY KEY,
         case_id INTEGER NOT NULL REFERENCES cases(id) ON DELETE CASCADE,
         type TEXT NOT NULL,
-        amount REAL NOT NULL,
+        amount_pence BIGINT NOT NULL,
         transaction_date DATE DEFAULT CURRENT_DATE,
         created_by INTEGER NOT NULL REFERENCES users(id),
         description TEXT,
         recoverable INTEGER DEFAULT 0,
         billable INTEGER DEFAULT 0,
-        vat_amount REAL DEFAULT 0.0,
+        vat_pence BIGINT DEFAULT 0,
         billed INTEGER DEFAULT 0,
         billeddate DATE,
         charge_id INTEGER REFERENCES charges(id)
@@ -117,14 +118,261 @@ def init_db(DATABASE_URL):
     if c.fetchone():
         c.execute("ALTER TABLE money RENAME COLUMN note TO description")
     # existing safe adds
-    c.execute("ALTER TABLE money ADD COLUMN IF NOT EXISTS vat_amount REAL DEFAULT 0.0")
     c.execute("ALTER TABLE money ADD COLUMN IF NOT EXISTS billed INTEGER DEFAULT 0")
     c.execute("ALTER TABLE money ADD COLUMN IF NOT EXISTS billeddate DATE")
     c.execute("ALTER TABLE money ADD COLUMN IF NOT EXISTS charge_id INTEGER REFERENCES charges(id)")
 
+    # Money moved from REAL pounds to BIGINT pence (see balances.py). One-off:
+    # converts money + money_archive and the snapshot tables in this transaction,
+    # drops money_all / aged_debt_mv so they are rebuilt below with the new columns
+    c.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'money' AND column_name = 'amount'")
+    if c.fetchone():
+        c.execute("DROP MATERIALIZED VIEW IF EXISTS aged_debt_mv")
+        c.execute("DROP VIEW IF EXISTS money_all")
+        for table in ('money', 'money_archive'):
+            c.execute("SELECT to_regclass(%s)", (table,))
+            if c.fetchone()[0] is None:
+                continue
+            c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS vat_amount REAL DEFAULT 0.0")
+            c.execute(f"ALTER TABLE {table} ADD COLUMN amount_pence BIGINT, ADD COLUMN vat_pence BIGINT DEFAULT 0")
+            c.execute(f"""
+                UPDATE {table}
+                SET amount_pence = round(amount::numeric * 100),
+                    vat_pence = round(COALESCE(vat_amount, 0)::numeric * 100)
+            """)
+            c.execute(f"ALTER TABLE {table} DROP COLUMN amount, DROP COLUMN vat_amount")
+        c.execute("ALTER TABLE money ALTER COLUMN amount_pence SET NOT NULL")
+        for table, columns in (('balance_snapshots', ('invoice', 'payment', 'charge', 'interest', 'balance')),
+                               ('client_balance_snapshots', ('balance',))):
+            c.execute("SELECT to_regclass(%s)", (table,))
+            if c.fetchone()[0] is None:
+                continue
+            for col in columns:
+                c.execute(f"ALTER TABLE {table} RENAME COLUMN {col} TO {col}_pence")
+                c.execute(f"""
+                    ALTER TABLE {table}
+                    ALTER COLUMN {col}_pence TYPE BIGINT USING round({col}_pence::numeric * 100),
+                    ALTER COLUMN {col}_pence SET DEFAULT 0
+                """)
+
     # NEW: store old next_action_date when undoing status changes
     c.execute("ALTER TABLE case_status_history ADD COLUMN IF NOT EXISTS old_next_action_date DATE")
 
+    # bulk status changes (routes/bulk.py) share a batch_id so they can be undone together
+    c.execute("ALTER TABLE case_status_history ADD COLUMN IF NOT EXISTS batch_id TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS case_status_history_batch_idx ON case_status_history (batch_id) WHERE batch_id IS NOT NULL")
+    # ...and so do bulk notes / letter runs
+    c.execute("ALTER TABLE notes ADD COLUMN IF NOT EXISTS batch_id TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS notes_batch_idx ON notes (batch_id) WHERE batch_id IS NOT NULL")
+
+    # --- BI EXPORT: the transaction that inserted each row (see ledger_export.py) ---
+    # Incremental exports go by this rather than by id, which isn't commit-ordered.
+    # Rows from before the column have NULL; the default only costs new inserts.
+    for table in ('money', 'cases', 'notes'):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS export_xid BIGINT")
+        c.execute(f"ALTER TABLE {table} ALTER COLUMN export_xid SET DEFAULT pg_current_xact_id()::text::bigint")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {table}_export_xid_idx ON {table} (export_xid)")
+
+    # --- ARCHIVE TABLES (see archive.py) ---
+    # Closed cases get their money / notes / history moved into <table>_archive.
+    # <table>_all = live + archive, used whenever archived rows need reading.
+    c.execute("ALTER TABLE cases ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS archive_checkpoint (
+        name TEXT PRIMARY KEY,
+        last_case_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    for table in ('money', 'notes', 'case_status_history'):
+        c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table}_archive (
+            LIKE {table} INCLUDING DEFAULTS,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        c.execute(f"CREATE INDEX IF NOT EXISTS {table}_archive_case_idx ON {table}_archive (case_id)")
+        # keep the archive in step with any column added to the live table later on
+        c.execute("""
+            SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+            FROM pg_attribute a
+            WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+            ORDER BY a.attnum
+        """, (table,))
+        columns = c.fetchall()
+        for name, col_type in columns:
+            c.execute(f'ALTER TABLE {table}_archive ADD COLUMN IF NOT EXISTS "{name}" {col_type}')
+        if table in ('money', 'notes'):
+            c.execute(f"CREATE INDEX IF NOT EXISTS {table}_archive_export_xid_idx ON {table}_archive (export_xid)")
+        col_list = ", ".join(f'"{name}"' for name, _ in columns)
+        # OR REPLACE (not DROP) - the reporting views below depend on money_all
+        c.execute(f"""
+        CREATE OR REPLACE VIEW {table}_all AS
+            SELECT {col_list} FROM {table}
+            UNION ALL
+            SELECT {col_list} FROM {table}_archive
+        """)
+
+    # --- CASE TIMELINE (see timeline.py) ---
+    # (case_id, time, id) on each event table, live and archive, so every
+    # branch of the merged timeline query is an ordered index range scan
+    for table, time_col in (('money', 'transaction_date'), ('notes', 'created_at'), ('case_status_history', 'changed_at')):
+        for t in (table, f"{table}_archive"):
+            c.execute(f"CREATE INDEX IF NOT EXISTS {t}_timeline_idx ON {t} (case_id, {time_col}, id)")
+    # superseded by case_status_history_timeline_idx
+    c.execute("DROP INDEX IF EXISTS case_status_history_case_changed_idx")
+
+    # --- FRAGMENT CACHE VERSIONS (see fragment_cache.py) ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS fragment_versions (
+        name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+
+    # --- REPORTING: NIGHTLY BALANCE SNAPSHOTS + AGED DEBT (see routes/reports.py) ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        snapshot_date DATE NOT NULL,
+        case_id INTEGER NOT NULL REFERENCES cases(id) ON DELETE CASCADE,
+        client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+        invoice_pence BIGINT DEFAULT 0,
+        payment_pence BIGINT DEFAULT 0,
+        charge_pence BIGINT DEFAULT 0,
+        interest_pence BIGINT DEFAULT 0,
+        balance_pence BIGINT DEFAULT 0,
+        PRIMARY KEY (snapshot_date, case_id)
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS balance_snapshots_case_idx ON balance_snapshots (case_id, snapshot_date)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS client_balance_snapshots (
+        snapshot_date DATE NOT NULL,
+        client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+        case_count INTEGER DEFAULT 0,
+        balance_pence BIGINT DEFAULT 0,
+        PRIMARY KEY (client_id, snapshot_date)
+    )
+    """)
+    # Ageing is FIFO: a case's credits (payments) pay off its oldest debits
+    # first, and each debit is aged by its transaction_date on whatever is
+    # left of it. So a recent part-payment reduces the old invoice's bucket
+    # instead of showing as a negative 0-30. Credit beyond every debit
+    # (overpaid) shows in 0-30. The buckets add up to balance_pence.
+    # Only what counts towards the balance is aged (balances.signed_pence).
+    # All amounts in pence. Refreshed CONCURRENTLY every night, which needs
+    # the unique index.
+    # Views made before the FIFO ageing are dropped so they're rebuilt.
+    c.execute("SELECT definition FROM pg_matviews WHERE matviewname = 'aged_debt_mv'")
+    row = c.fetchone()
+    if row and 'fifo' not in row[0]:
+        c.execute("DROP MATERIALIZED VIEW aged_debt_mv")
+    c.execute(f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS aged_debt_mv AS
+    WITH entries AS (
+        SELECT m.case_id, m.transaction_date, m.id, {signed_pence('m')} AS amt
+        FROM money_all m
+    ),
+    debits AS (
+        SELECT case_id, transaction_date, amt,
+               SUM(amt) OVER (PARTITION BY case_id ORDER BY transaction_date, id) AS running
+        FROM entries
+        WHERE amt > 0
+    ),
+    credits AS (
+        SELECT case_id, -SUM(amt) AS paid FROM entries WHERE amt < 0 GROUP BY case_id
+    ),
+    fifo AS (
+        -- what is left of each debit once the credits have paid off the older ones
+        SELECT d.case_id, CURRENT_DATE - d.transaction_date AS age,
+               GREATEST(0, LEAST(d.amt, d.running - COALESCE(cr.paid, 0))) AS amt
+        FROM debits d
+        LEFT JOIN credits cr ON cr.case_id = d.case_id
+        UNION ALL
+        -- overpaid: the credit left once every debit is paid
+        SELECT cr.case_id, 0, LEAST(0, COALESCE(SUM(d.amt), 0) - cr.paid)
+        FROM credits cr
+        LEFT JOIN debits d ON d.case_id = cr.case_id
+        GROUP BY cr.case_id, cr.paid
+    )
+    SELECT s.client_id,
+           COUNT(DISTINCT s.id) AS case_count,
+           COALESCE(SUM(a.amt) FILTER (WHERE a.age <= 30), 0)::bigint AS pence_0_30,
+           COALESCE(SUM(a.amt) FILTER (WHERE a.age BETWEEN 31 AND 60), 0)::bigint AS pence_31_60,
+           COALESCE(SUM(a.amt) FILTER (WHERE a.age BETWEEN 61 AND 90), 0)::bigint AS pence_61_90,
+           COALESCE(SUM(a.amt) FILTER (WHERE a.age > 90), 0)::bigint AS pence_90_plus,
+           COALESCE(SUM(a.amt), 0)::bigint AS balance_pence,
+           CURRENT_TIMESTAMP AS refreshed_at
+    FROM cases s
+    LEFT JOIN fifo a ON a.case_id = s.id
+    GROUP BY s.client_id
+    """)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS aged_debt_mv_client_idx ON aged_debt_mv (client_id)")
+
+    # --- DUPLICATE DEBTOR BLOCKING KEYS (see dedupe.py) ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS debtor_keys (
+        case_id INTEGER NOT NULL REFERENCES cases(id) ON DELETE CASCADE,
+        client_id INTEGER NOT NULL,
+        key_type TEXT NOT NULL,
+        key_value TEXT NOT NULL,
+        PRIMARY KEY (case_id, key_type, key_value)
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS debtor_keys_block_idx ON debtor_keys (client_id, key_type, key_value)")
+
+    # --- BI EXPORT WATERMARKS (see ledger_export.py) ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS export_watermarks (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # last_id is the old id watermark, only read until a run saves last_xid
+    c.execute("ALTER TABLE export_watermarks ADD COLUMN IF NOT EXISTS last_xid BIGINT")
+
+    # --- BULK RUN PROGRESS (see routes/bulk.py) ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bulk_runs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        created_by INTEGER REFERENCES users(id),
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """)
+
+    # --- REQUEST PROFILES (see profiler.py) - shared by every worker, last PROFILE_KEEP kept ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS request_profiles (
+        id BIGSERIAL PRIMARY KEY,
+        at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        method TEXT,
+        path TEXT,
+        endpoint TEXT,
+        status INTEGER,
+        username TEXT,
+        worker_pid INTEGER,
+        total_ms DOUBLE PRECISION,
+        db_ms DOUBLE PRECISION,
+        queries JSONB,
+        stats_text TEXT,
+        stats_raw BYTEA
+    )
+    """)
+
+    # --- LOAD SHEDDING / QUERY TIMEOUT COUNTERS (see load_limits.py) ---
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS load_counters (
+        name TEXT PRIMARY KEY,
+        count BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
     conn.commit()
     conn.close()
 
@@ -0,0 +1,202 @@
+# =============================================================================
+#  LEDGER EXPORT - RAW TABLE DUMPS FOR THE BI TEAM
+#  • money / cases / notes, whole or sliced by client and by watermark
+#  • CSV comes straight out of COPY ... TO STDOUT, chunk by chunk - nothing
+#    is held in memory and Postgres does the formatting
+#  • Parquet is written one row group per EXPORT_BATCH_ROWS rows from a
+#    server-side cursor, so memory stays flat there too (needs pyarrow)
+#  • Incremental by transaction, not by id: every row records the xid that
+#    inserted it (export_xid, see init_db.py). The watermark is the oldest
+#    transaction still running when the export starts - everything below it
+#    has finished, so nothing can still turn up under it. A row whose
+#    transaction was still open is picked up by the next run. An id
+#    watermark can't do that: ids are handed out at insert, not at commit, so
+#    a long transaction (a bulk COPY) commits ids below ones already exported.
+#    Inserts only - an edit to an old row is not picked up until the next
+#    full export.
+#  Used by /export/<table>.<fmt> (routes/admin.py) and:
+#    flask --app app export run money --format parquet --out money.parquet --incremental
+# =============================================================================
+
+import os
+import sys
+import click
+from flask.cli import AppGroup
+from psycopg import sql
+from psycopg.postgres import types as pg_types
+from extensions import get_db
+from archive import source
+
+EXPORT_TABLES = ('money', 'cases', 'notes')
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 50000))
+
+
+def high_watermark(db):
+    """Oldest transaction still in progress - every row with export_xid below it is committed
+    (or never will be). Export up to here, and start from here next time."""
+    c = db.cursor()
+    c.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS hi")
+    return c.fetchone()['hi']
+
+
+def export_query(table, client_id=None, since_xid=None, until_xid=None, include_archived=False, since_id=None):
+    """since_xid / until_xid: the watermarks (see high_watermark). since_id: just rows above an id.
+    Rows from before export_xid existed have none - they count as below any until_xid."""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Can't export {table}")
+    src = table if table == 'cases' else source(table, include_archived)
+    where = []
+    if since_xid is not None:
+        where.append(sql.SQL("t.export_xid >= {}").format(sql.Literal(int(since_xid))))
+    if until_xid is not None:
+        where.append(sql.SQL("(t.export_xid IS NULL OR t.export_xid < {})").format(sql.Literal(int(until_xid))))
+    if since_id is not None:
+        where.append(sql.SQL("t.id > {}").format(sql.Literal(int(since_id))))
+    if client_id is not None:
+        if table == 'cases':
+            where.append(sql.SQL("t.client_id = {}").format(sql.Literal(int(client_id))))
+        else:
+            where.append(sql.SQL("t.case_id IN (SELECT id FROM cases WHERE client_id = {})")
+                         .format(sql.Literal(int(client_id))))
+    query = sql.SQL("SELECT t.* FROM {} t").format(sql.Identifier(src))
+    if where:
+        query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(where)
+    return query + sql.SQL(" ORDER BY t.id")
+
+
+# ----------------------------------------------------------------------
+#  CSV - COPY TO STDOUT
+# ----------------------------------------------------------------------
+def stream_csv(db, query):
+    """Yield CSV (with header) as bytes, in whatever chunks Postgres sends them."""
+    copy_sql = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)").format(query)
+    with db.cursor().copy(copy_sql) as copy:
+        for chunk in copy:
+            yield bytes(chunk)
+
+
+# ----------------------------------------------------------------------
+#  PARQUET - batches from a server-side cursor
+# ----------------------------------------------------------------------
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written since the last drain()."""
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _arrow_schema(pa, description):
+    arrow_types = {
+        'int2': pa.int16(), 'int4': pa.int32(), 'int8': pa.int64(),
+        'float4': pa.float32(), 'float8': pa.float64(), 'numeric': pa.float64(),
+        'bool': pa.bool_(), 'date': pa.date32(),
+        'timestamp': pa.timestamp('us'), 'timestamptz': pa.timestamp('us', tz='UTC'),
+        'bytea': pa.binary(),
+    }
+    fields = []
+    for col in description:
+        info = pg_types.get(col.type_code)
+        fields.append(pa.field(col.name, arrow_types.get(info.name if info else None, pa.string())))
+    return pa.schema(fields)
+
+
+def stream_parquet(db, query, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield a Parquet file as bytes, one row group per batch."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+
+    sink = _ChunkSink()
+    with db.cursor(name='ledger_export') as c:
+        c.itersize = batch_rows
+        c.execute(query)
+        rows = c.fetchmany(batch_rows)
+        schema = _arrow_schema(pa, c.description)
+        with pq.ParquetWriter(sink, schema, compression='snappy') as writer:
+            while rows:
+                columns = {f.name: [r[f.name] for r in rows] for f in schema}
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+                yield sink.drain()
+                rows = c.fetchmany(batch_rows)
+        yield sink.drain()
+
+
+def stream_export(db, fmt, query):
+    if fmt == 'csv':
+        return stream_csv(db, query)
+    if fmt == 'parquet':
+        return stream_parquet(db, query)
+    raise ValueError(f"Unknown format {fmt}")
+
+
+# =============================================================================
+#  CLI - registered in app.py
+# =============================================================================
+
+export_cli = AppGroup('export', help='Raw data export for BI.')
+
+
+@export_cli.command('run')
+@click.argument('table', type=click.Choice(EXPORT_TABLES))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'parquet']), default='csv', show_default=True)
+@click.option('--out', default='-', help='File to write, - for stdout.')
+@click.option('--client', 'client_id', type=int, default=None)
+@click.option('--since-id', type=int, default=None, help='Only rows with id above this.')
+@click.option('--incremental', is_flag=True, help='Carry on from the watermark saved by the last incremental run.')
+@click.option('--include-archived', is_flag=True)
+def export_run(table, fmt, out, client_id, since_id, incremental, include_archived):
+    db = get_db()
+    c = db.cursor()
+    name = f"{table}:{client_id or 'all'}{':archived' if include_archived else ''}"
+    since_xid = None
+    if incremental:
+        c.execute("SELECT last_id, last_xid FROM export_watermarks WHERE name = %s", (name,))
+        row = c.fetchone()
+        if row and row['last_xid'] is not None:
+            since_xid = row['last_xid']
+        elif row:
+            since_id = row['last_id']   # saved before the xid watermark - one last run by id
+
+    until_xid = high_watermark(db)
+    query = export_query(table, client_id, since_xid, until_xid, include_archived, since_id)
+
+    f = sys.stdout.buffer if out == '-' else open(out, 'wb', buffering=1024 * 1024)
+    try:
+        written = 0
+        for chunk in stream_export(db, fmt, query):
+            f.write(chunk)
+            written += len(chunk)
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+
+    if incremental:
+        c.execute("""
+            INSERT INTO export_watermarks (name, last_xid) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET last_xid = EXCLUDED.last_xid, updated_at = CURRENT_TIMESTAMP
+        """, (name, until_xid))
+        db.commit()
+    click.echo(f"{table}: {written} bytes, transactions {since_xid or 0}-{until_xid}", err=True)
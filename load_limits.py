@@ -0,0 +1,119 @@
+# =============================================================================
+#  LOAD LIMITS - KEEP ONE BIG REPORT FROM TAKING THE DASHBOARD DOWN WITH IT
+#  • Query budgets: every request's connection gets a statement_timeout.
+#    Interactive pages get STATEMENT_TIMEOUT_MS (short, see extensions.py);
+#    heavy routes are marked @query_budget(ms) and get longer. get_db() applies it when it
+#    connects, so it costs no extra round trip. CLI jobs get no limit.
+#  • Concurrency: routes marked @expensive('pool') need one of that pool's
+#    slots. Slots are Postgres advisory locks, so the limit holds across every
+#    gunicorn worker and server. A slot goes when the request's connection
+#    closes, which includes a streamed response finishing or a worker dying.
+#    A request with no free slot gets 503 + Retry-After straight away - it
+#    never waits in the worker, which would tie up the worker and its DB
+#    connection, the very thing the slots are there to prevent.
+#  • take_slot() / release_slot() can hold a slot for just part of a request:
+#    /login holds a 'login' slot only while bcrypt runs (routes/auth.py)
+#  • A query that hits its timeout is answered 503 + Retry-After as well
+#  • Counters (admitted / shed / timed out, per pool or route) are
+#    kept in load_counters and shown at /admin/load
+# =============================================================================
+
+import os
+from functools import wraps
+from flask import current_app, request, jsonify
+from extensions import get_db, statement_timeout_for_request
+
+REPORT_TIMEOUT_MS = int(os.environ.get('REPORT_TIMEOUT_MS', 120000))
+EXPORT_TIMEOUT_MS = int(os.environ.get('EXPORT_TIMEOUT_MS', 900000))
+BULK_TIMEOUT_MS = int(os.environ.get('BULK_TIMEOUT_MS', 60000))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 30))
+
+# slots per pool - how many of these may run at once across the whole site
+POOL_SLOTS = {
+    'reports': int(os.environ.get('REPORT_SLOTS', 2)),
+    'export': int(os.environ.get('EXPORT_SLOTS', 1)),
+    'bulk': int(os.environ.get('BULK_SLOTS', 2)),
+    # bcrypt checks - each one is a CPU for ~0.25s (hashing.py, routes/auth.py)
+    'login': int(os.environ.get('LOGIN_SLOTS', 4)),
+}
+
+
+def query_budget(ms):
+    """statement_timeout for this route's queries (0 = none). Put it under @login_required."""
+    def decorator(view):
+        view.statement_timeout_ms = ms
+        return view
+    return decorator
+
+
+def count(db, *names):
+    c = db.cursor()
+    c.execute("""
+        INSERT INTO load_counters (name, count)
+        SELECT unnest(%s::text[]), 1
+        ON CONFLICT (name) DO UPDATE
+        SET count = load_counters.count + 1, updated_at = CURRENT_TIMESTAMP
+    """, (list(names),))
+    db.commit()
+
+
+def busy_response(message, retry_after=RETRY_AFTER_SECONDS):
+    headers = {'Retry-After': str(retry_after)}
+    if request.path.startswith('/api/') or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': message, 'retry_after': retry_after}), 503, headers
+    return message, 503, headers
+
+
+def take_slot(db, pool):
+    """One of the pool's slots (its number), or None if they're all taken.
+    Held until release_slot() or until the connection closes."""
+    c = db.cursor()
+    # try every slot once; LIMIT 1 stops at the first one we get
+    c.execute("""
+        SELECT s FROM generate_series(0, %s - 1) AS s
+        WHERE pg_try_advisory_lock(hashtext(%s), s)
+        LIMIT 1
+    """, (POOL_SLOTS[pool], 'load_limits:' + pool))
+    row = c.fetchone()
+    db.commit()
+    return row['s'] if row else None
+
+
+def release_slot(db, pool, slot):
+    c = db.cursor()
+    c.execute("SELECT pg_advisory_unlock(hashtext(%s), %s)", ('load_limits:' + pool, slot))
+    db.commit()
+
+
+def expensive(pool, when=None):
+    """Only POOL_SLOTS[pool] of these run at once; the rest get 503 + Retry-After at once.
+    when: optional callable - only take a slot if it returns true (e.g. a form
+    page that is only heavy once it has been filled in)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if when is not None and not when():
+                return view(*args, **kwargs)
+            db = get_db()
+            if take_slot(db, pool) is None:
+                count(db, f'{pool}:shed')
+                return busy_response(f'Too many {pool} requests running - try again shortly')
+            count(db, f'{pool}:admitted')
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def handle_query_canceled(e):
+    """Registered in app.py for psycopg.errors.QueryCanceled (statement_timeout hit)."""
+    db = get_db()
+    db.rollback()
+    count(db, f'timeout:{request.endpoint}')
+    current_app.logger.warning("statement_timeout (%s ms) hit on %s", statement_timeout_for_request(), request.path)
+    return busy_response('That took too long and was stopped - try again, or narrow it down')
+
+
+def counters(db):
+    c = db.cursor()
+    c.execute("SELECT name, count, updated_at FROM load_counters ORDER BY name")
+    return c.fetchall()
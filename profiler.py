@@ -0,0 +1,129 @@
+# =============================================================================
+#  PROFILER - OPT-IN PER-REQUEST PROFILING FOR WHEN A PAGE IS SLOW IN PROD
+#  • An admin adds ?_profile=1 or the header X-Profile: 1 to any request, or
+#    PROFILE_SAMPLE_PERCENT of all traffic is picked at random
+#  • A picked request runs under cProfile and every query it makes through
+#    get_db() is timed (TimedCursor in extensions.py)
+#  • Profiles go into the request_profiles table, so /admin/profiles (next to
+#    /db_structure) shows every gunicorn worker's, and X-Profile-Id is the
+#    row id - the same on whichever worker serves the admin page. Only the
+#    last PROFILE_KEEP are kept.
+#  • Saved on a connection of its own, so a request whose transaction failed
+#    still gets its profile and the save never shows up in its query log
+#  Only one request per worker is profiled at a time (cProfile can't nest);
+#  if one is already running the next just isn't profiled.
+# =============================================================================
+
+import cProfile
+import io
+import json
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+import psycopg
+from flask import g, request
+from flask_login import current_user
+from extensions import DATABASE_URL
+
+PROFILE_SAMPLE_PERCENT = float(os.environ.get('PROFILE_SAMPLE_PERCENT', 0))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', 40))
+
+_running = threading.Lock()
+
+
+def _requested():
+    if request.args.get('_profile') or request.headers.get('X-Profile'):
+        return current_user.is_authenticated and getattr(current_user, 'role', None) == 'admin'
+    return False
+
+
+def _start():
+    if request.endpoint in ('static', 'admin.profiles', 'admin.profile_detail', 'admin.profile_download'):
+        return
+    if not (_requested() or (PROFILE_SAMPLE_PERCENT and random.random() * 100 < PROFILE_SAMPLE_PERCENT)):
+        return
+    if not _running.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.query_log = []
+    g.profile_started = time.perf_counter()
+    g.profiler.enable()
+
+
+def _finish(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    _running.release()
+    total_ms = (time.perf_counter() - g.profile_started) * 1000
+    queries = g.pop('query_log', [])
+
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+
+    queries = [dict(q, start=(q['start'] - g.profile_started) * 1000) for q in queries]
+    profile_id = _save({
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'username': current_user.username if current_user.is_authenticated else None,
+        'worker_pid': os.getpid(),
+        'total_ms': total_ms,
+        'db_ms': sum(q['ms'] for q in queries),
+        'queries': json.dumps(queries),
+        'stats_text': out.getvalue(),
+        'stats_raw': marshal.dumps(stats.stats),   # readable by pstats / snakeviz
+    })
+    response.headers['X-Profile-Id'] = str(profile_id)
+    return response
+
+
+def _abandon(exc=None):
+    # request blew up before after_request - don't leave the profiler or lock held
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _running.release()
+
+
+# ----------------------------------------------------------------------
+#  STORAGE - request_profiles (init_db.py)
+# ----------------------------------------------------------------------
+def _save(profile):
+    with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+        with conn.transaction():
+            profile_id = conn.execute(f"""
+                INSERT INTO request_profiles ({', '.join(profile)})
+                VALUES ({', '.join(f'%({k})s' for k in profile)}) RETURNING id
+            """, profile).fetchone()[0]
+            conn.execute("DELETE FROM request_profiles WHERE id <= %s", (profile_id - PROFILE_KEEP,))
+    return profile_id
+
+
+def recent_profiles(db):
+    c = db.cursor()
+    c.execute("""
+        SELECT id, at, method, path, status, username, worker_pid, total_ms, db_ms,
+               jsonb_array_length(queries) AS query_count
+        FROM request_profiles ORDER BY id DESC LIMIT %s
+    """, (PROFILE_KEEP,))
+    return c.fetchall()
+
+
+def get_profile(db, profile_id):
+    c = db.cursor()
+    c.execute("SELECT * FROM request_profiles WHERE id = %s", (profile_id,))
+    return c.fetchone()
+
+
+def init_profiler(app):
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_abandon)
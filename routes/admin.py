@@ -1,13 +1,22 @@
 # =============================================================================
 #  ADMIN ROUTES
 #  • /db_structure  – shows all tables/columns (useful for debugging)
+#  • /admin/db_health – sizes, bloat, unused / missing indexes, top statements (admins only)
 #  • API key management (generate, list, revoke)
+#  • /export/<table>.<csv|parquet> – streaming raw data export (admins only)
+#  • /admin/profiles – request profiles captured by profiler.py (admins only)
+#  • /admin/load – load-shedding / query timeout counters (admins only)
 #  Only logged-in users can access these
 # =============================================================================
 
-from flask import Blueprint, render_template, request, jsonify
+from flask import Blueprint, render_template, request, jsonify, Response, stream_with_context, abort
 from flask_login import login_required
 from extensions import get_db
+from routes.auth import admin_required
+from ledger_export import EXPORT_TABLES, export_query, high_watermark, stream_export
+from load_limits import query_budget, expensive, counters, POOL_SLOTS, EXPORT_TIMEOUT_MS
+from db_health import db_health, DB_HEALTH_CACHE_SECONDS
+from profiler import recent_profiles, get_profile, PROFILE_KEEP, PROFILE_SAMPLE_PERCENT
 import uuid
 
 admin_bp = Blueprint('admin', __name__)
@@ -16,29 +25,16 @@ admin_bp = Blueprint('admin', __name__)
 @admin_bp.route('/db_structure')
 @login_required
 def db_structure():
-    db = get_db()
-    c = db.cursor()
+    # every table's columns come from the one cached introspection query (db_health.py)
+    structure = {t['name']: t['columns'] for t in db_health(get_db())['tables']}
+    return render_template('db_structure.html', structure=structure)
 
-    # Get all tables
-    c.execute("""
-        SELECT table_name 
-        FROM information_schema.tables
-        WHERE table_schema = 'public'
-        ORDER BY table_name
-    """)
-    tables = [row['table_name'] for row in c.fetchall()]
-
-    structure = {}
-    for t in tables:
-        c.execute(f"""
-            SELECT column_name, data_type, is_nullable, column_default
-            FROM information_schema.columns
-            WHERE table_name = %s
-            ORDER BY ordinal_position
-        """, (t,))
-        structure[t] = c.fetchall()
 
-    return render_template('db_structure.html', structure=structure)
+@admin_bp.route('/admin/db_health')
+@admin_required
+def db_health_page():
+    health = db_health(get_db(), refresh=bool(request.args.get('refresh')))
+    return render_template('db_health.html', health=health, cache_seconds=DB_HEALTH_CACHE_SECONDS)
 
 
 # =============================================================================
@@ -76,3 +72,77 @@ def revoke_key(key_id):
     c.execute("UPDATE api_keys SET active = 0 WHERE id = %s", (key_id,))
     db.commit()
     return '', 204
+
+
+# =============================================================================
+#  RAW DATA EXPORT (BI) – streamed, see ledger_export.py
+#  /export/money.csv?client_id=3&since=48213377&include_archived=1
+#  The X-Export-Watermark header is the `since` to use next time
+#  (a transaction id, not a row id - see ledger_export.py).
+# =============================================================================
+
+@admin_bp.route('/export/<table>.<fmt>')
+@admin_required
+@expensive('export')
+@query_budget(EXPORT_TIMEOUT_MS)
+def export_table(table, fmt):
+    if table not in EXPORT_TABLES or fmt not in ('csv', 'parquet'):
+        return "Unknown export", 404
+
+    db = get_db()
+    include_archived = request.args.get('include_archived') == '1'
+    since = request.args.get('since', type=int)
+    until = high_watermark(db)
+    query = export_query(table, request.args.get('client_id', type=int), since, until, include_archived,
+                         request.args.get('since_id', type=int))
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/vnd.apache.parquet'
+    return Response(
+        stream_with_context(stream_export(db, fmt, query)),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename={table}_{since or 0}_{until}.{fmt}',
+            'X-Export-Watermark': str(until),
+        },
+    )
+
+
+# =============================================================================
+#  REQUEST PROFILES – see profiler.py
+#  Add ?_profile=1 (or header X-Profile: 1) to any page as an admin, then look
+#  here. Every worker's profiles are listed (request_profiles table).
+# =============================================================================
+
+@admin_bp.route('/admin/profiles')
+@admin_required
+def profiles():
+    return render_template('profiles.html', profiles=recent_profiles(get_db()), profile=None,
+                           keep=PROFILE_KEEP, sample_percent=PROFILE_SAMPLE_PERCENT)
+
+
+@admin_bp.route('/admin/profiles/<int:profile_id>')
+@admin_required
+def profile_detail(profile_id):
+    profile = get_profile(get_db(), profile_id)
+    if not profile:
+        abort(404)
+    return render_template('profiles.html', profiles=None, profile=profile)
+
+
+@admin_bp.route('/admin/profiles/<int:profile_id>.prof')
+@admin_required
+def profile_download(profile_id):
+    profile = get_profile(get_db(), profile_id)
+    if not profile:
+        abort(404)
+    return Response(bytes(profile['stats_raw']), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename=profile_{profile_id}.prof'})
+
+
+@admin_bp.route('/admin/load')
+@admin_required
+def load_counters():
+    rows = counters(get_db())
+    return jsonify({'slots': POOL_SLOTS,
+                    'counters': {r['name']: {'count': r['count'], 'updated_at': r['updated_at'].isoformat()}
+                                 for r in rows}})
@@ -7,10 +7,13 @@
 #  • User class & user loader
 # =============================================================================
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from functools import wraps
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, g, current_app
 from flask_login import login_user, logout_user, login_required, current_user, LoginManager, UserMixin
 from extensions import get_db
-import bcrypt
+from hashing import (check_password, check_unknown_user, hash_password, needs_rehash, HashingBusy,
+                     user_throttle, ip_throttle)
+from load_limits import take_slot, release_slot, count
 
 # Blueprint for all auth-related routes
 auth_bp = Blueprint('auth', __name__)
@@ -37,6 +40,16 @@ def load_user(user_id):
         return User(row['id'], row['username'], row['role'])
     return None
 
+# Use instead of @login_required on anything only admins should reach
+def admin_required(view):
+    @wraps(view)
+    @login_required
+    def wrapped(*args, **kwargs):
+        if current_user.role != 'admin':
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapped
+
 # Attach login_manager to the app when the blueprint loads
 @auth_bp.record_once
 def on_load(state):
@@ -46,18 +59,74 @@ def on_load(state):
 #  ROUTES
 # =============================================================================
 
+def _hold_slot_until_done(busy):
+    # A timed-out bcrypt keeps running. The 'login' slot is an advisory lock on
+    # this request's connection, so take the connection away from teardown and
+    # close it - freeing the slot - only when that hash has really finished.
+    conn = g.pop('db', None)
+    if conn is not None:
+        busy.future.add_done_callback(lambda f: conn.close())
+
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        ip = request.remote_addr or ''
+
+        # Throttled before any hashing happens, so hammering /login costs us nothing
+        wait = max(user_throttle.retry_after(username), ip_throttle.retry_after(ip))
+        if wait:
+            flash(f'Too many login attempts - try again in {wait} seconds')
+            return render_template('login.html'), 429, {'Retry-After': str(wait)}
+
         db = get_db()
         c = db.cursor()
         c.execute("SELECT id, username, password_hash, role FROM users WHERE username = %s", (username,))
         user = c.fetchone()
-        if user and bcrypt.checkpw(password.encode(), user['password_hash']):
+        if user is None:
+            # no slot for a name that doesn't exist, but the same bcrypt work -
+            # answering faster would tell you which usernames are real
+            try:
+                ok = check_unknown_user(password)
+            except HashingBusy:
+                ok = False
+        else:
+            # Only LOGIN_SLOTS bcrypt checks run at once across all workers - the rest get 503 straight away
+            slot = take_slot(db, 'login')
+            if slot is None:
+                count(db, 'login:shed')
+                flash('Login is busy right now - please try again in a moment')
+                return render_template('login.html'), 503, {'Retry-After': '2'}
+            try:
+                ok = check_password(password, user['password_hash'])
+            except HashingBusy as busy:
+                _hold_slot_until_done(busy)
+                flash('Login is busy right now - please try again in a moment')
+                return render_template('login.html'), 503, {'Retry-After': '2'}
+
+            # Upgrade hashes made with an older BCRYPT_ROUNDS while we have the password.
+            # Best effort - if it times out they're still logged in, and it's done next time.
+            if ok and needs_rehash(user['password_hash']):
+                try:
+                    c.execute("UPDATE users SET password_hash = %s WHERE id = %s",
+                              (hash_password(password), user['id']))
+                    db.commit()
+                except HashingBusy as busy:
+                    current_app.logger.warning("password rehash for %s timed out", username)
+                    _hold_slot_until_done(busy)
+                    slot = None
+            if slot is not None:
+                release_slot(db, 'login', slot)
+
+        if ok:
+            user_throttle.clear(username)
             login_user(User(user['id'], user['username'], user['role']))
             return redirect(url_for('case.dashboard'))  # main page after login
+        # only failures count - a whole office logging in at 9am behind one IP is fine
+        user_throttle.hit(username)
+        ip_throttle.hit(ip)
         flash('Invalid username or password')
     return render_template('login.html')
 
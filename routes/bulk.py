@@ -0,0 +1,462 @@
+# =============================================================================
+#  BULK ROUTES - CHANGE MANY CASES AT ONCE
+#  • Bulk status update: ticked cases on the client page (/client/<id>), a filter
+#    (client / status / substatus) or the JSON API
+#  • Bulk undo of a whole status batch
+#  • Bulk notes / letter runs: one templated note on every case in a filter or
+#    uploaded id list, written with COPY, progress in bulk_runs
+#  Every change is set-based: one UPDATE ... RETURNING feeding one
+#  INSERT ... SELECT into case_status_history per chunk of cases, each chunk
+#  in its own transaction. All history rows from one run share a batch_id,
+#  which is what bulk undo works from.
+# =============================================================================
+
+import os
+import re
+import uuid
+from datetime import date
+from flask import Blueprint, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from extensions import get_db, money, format_date
+from archive import restore_case
+from balances import signed_pence
+from fragment_cache import bump, version_name
+from load_limits import query_budget, expensive, BULK_TIMEOUT_MS
+
+bulk_bp = Blueprint('bulk', __name__)
+
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+BULK_NOTE_CHUNK_SIZE = int(os.environ.get('BULK_NOTE_CHUNK_SIZE', 5000))
+
+
+def _chunks(ids, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _id(value):
+    # form fields are strings, JSON may send anything - only plain digits are an id
+    if isinstance(value, bool) or not str(value).isdigit():
+        raise ValueError(f"Not an id: {value!r}")
+    return int(value)
+
+
+def resolve_case_ids(db, case_ids=None, client_id=None, status=None, substatus=None):
+    """Explicit ids win; otherwise every case matching the filter. Needs at least one of them.
+    Raises ValueError for an id that isn't a number."""
+    c = db.cursor()
+    if case_ids:
+        if not isinstance(case_ids, list):
+            raise ValueError("case_ids must be a list")
+        c.execute("SELECT id FROM cases WHERE id = ANY(%s) ORDER BY id", ([_id(i) for i in case_ids],))
+    else:
+        where, params = [], []
+        if client_id:
+            where.append("client_id = %s")
+            params.append(_id(client_id))
+        if status:
+            where.append("status = %s")
+            params.append(status)
+        if substatus:
+            where.append("substatus = %s")
+            params.append(substatus)
+        if not where:
+            return []
+        c.execute(f"SELECT id FROM cases WHERE {' AND '.join(where)} ORDER BY id", params)
+    return [r['id'] for r in c.fetchall()]
+
+
+def _after_change(db, rows):
+    # Invalidate the dashboard fragments and bring back any re-opened archived case
+    names = set()
+    for r in rows:
+        names.add(version_name('client_cases', r['client_id']))
+        names.add(version_name('case_history', r['id']))
+        if r['archived_at'] and r['status'] != 'Closed':
+            restore_case(db, r['id'])
+    bump(db, *names)
+
+
+# ----------------------------------------------------------------------
+#  THE SET-BASED WORK
+# ----------------------------------------------------------------------
+def bulk_update_status(db, case_ids, status, substatus=None, next_action_date=None, user_id=None):
+    """Set status/substatus on every case (next_action_date only when given).
+    Returns (batch_id, number of cases that actually changed)."""
+    batch_id = uuid.uuid4().hex
+    updated = 0
+    c = db.cursor()
+    for chunk in _chunks(case_ids):
+        c.execute("""
+            WITH old AS (
+                SELECT id, status, substatus, next_action_date
+                FROM cases
+                WHERE id = ANY(%(ids)s)
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE cases s
+                SET status = %(status)s::text,
+                    substatus = %(substatus)s::text,
+                    next_action_date = COALESCE(%(next_action_date)s::text, s.next_action_date)
+                FROM old
+                WHERE s.id = old.id
+                  AND (old.status IS DISTINCT FROM %(status)s::text
+                       OR old.substatus IS DISTINCT FROM %(substatus)s::text
+                       OR old.next_action_date IS DISTINCT FROM COALESCE(%(next_action_date)s::text, old.next_action_date))
+                RETURNING s.id, s.client_id, s.archived_at, s.status,
+                          old.status AS old_status, old.substatus AS old_substatus,
+                          old.next_action_date AS old_next_action_date
+            ),
+            history AS (
+                INSERT INTO case_status_history
+                    (case_id, old_status, old_substatus, new_status, new_substatus,
+                     changed_by, old_next_action_date, batch_id)
+                SELECT id, old_status, old_substatus, %(status)s::text, %(substatus)s::text,
+                       %(user_id)s,
+                       CASE WHEN old_next_action_date ~ '^\d{4}-\d{2}-\d{2}$'
+                            THEN old_next_action_date::date END,
+                       %(batch_id)s
+                FROM changed
+            )
+            SELECT id, client_id, archived_at, status FROM changed
+        """, {'ids': chunk, 'status': status, 'substatus': substatus,
+              'next_action_date': next_action_date, 'user_id': user_id, 'batch_id': batch_id})
+        rows = c.fetchall()
+        _after_change(db, rows)
+        db.commit()
+        updated += len(rows)
+    return batch_id, updated
+
+
+def bulk_undo_status(db, batch_id):
+    """Revert a batch. Cases whose status has changed again since are left alone.
+    Returns (reverted, skipped)."""
+    c = db.cursor()
+    c.execute("SELECT case_id FROM case_status_history WHERE batch_id = %s ORDER BY case_id", (batch_id,))
+    case_ids = [r['case_id'] for r in c.fetchall()]
+
+    reverted = 0
+    for chunk in _chunks(case_ids):
+        c.execute("""
+            WITH latest AS (
+                SELECT DISTINCT ON (h.case_id)
+                       h.id, h.case_id, h.old_status, h.old_substatus, h.old_next_action_date, h.batch_id
+                FROM case_status_history h
+                WHERE h.case_id = ANY(%(ids)s)
+                ORDER BY h.case_id, h.changed_at DESC, h.id DESC
+            ),
+            reverted AS (
+                UPDATE cases s
+                SET status = l.old_status,
+                    substatus = l.old_substatus,
+                    next_action_date = l.old_next_action_date::text
+                FROM latest l
+                WHERE s.id = l.case_id AND l.batch_id = %(batch_id)s
+                RETURNING s.id, s.client_id, s.archived_at, s.status, l.id AS history_id
+            ),
+            removed AS (
+                DELETE FROM case_status_history WHERE id IN (SELECT history_id FROM reverted)
+            )
+            SELECT id, client_id, archived_at, status FROM reverted
+        """, {'ids': chunk, 'batch_id': batch_id})
+        rows = c.fetchall()
+        _after_change(db, rows)
+        db.commit()
+        reverted += len(rows)
+    return reverted, len(case_ids) - reverted
+
+
+# ----------------------------------------------------------------------
+#  BULK NOTES / LETTER RUNS
+#  The template is plain text with {field} placeholders, e.g.
+#    "Letter LBA1 sent to {debtor_name} at {postcode}, balance {balance}"
+#  Each chunk of cases is one SELECT for the fields, one COPY into notes and
+#  one bulk_runs update, committed together - so progress is exact and a
+#  failure part-way leaves whole chunks behind, all tagged with the batch_id.
+# ----------------------------------------------------------------------
+NOTE_FIELDS = {
+    'case_id': "s.id",
+    'debtor_name': "COALESCE(NULLIF(s.debtor_business_name, ''), s.debtor_first || ' ' || s.debtor_last)",
+    'debtor_first': "s.debtor_first",
+    'debtor_last': "s.debtor_last",
+    'client_name': "cl.business_name",
+    'status': "s.status",
+    'substatus': "s.substatus",
+    'next_action_date': "s.next_action_date",
+    'postcode': "s.postcode",
+    'email': "s.email",
+    'phone': "s.phone",
+    # only worked out if the template uses it
+    'balance': f"""(SELECT COALESCE(SUM({signed_pence('m')}), 0)::bigint
+                   FROM money_all m WHERE m.case_id = s.id)""",
+}
+_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+
+def template_fields(template):
+    """Placeholders used by the template. Raises ValueError for unknown ones."""
+    used = set(_PLACEHOLDER.findall(template))
+    unknown = used - set(NOTE_FIELDS) - {'today'}
+    if unknown:
+        raise ValueError("Unknown field(s): " + ", ".join(sorted(unknown)))
+    return used
+
+
+def _render(template, row, today):
+    def field(m):
+        name = m.group(1)
+        if name == 'today':
+            return today
+        value = row[name]
+        if name == 'balance':
+            return money(value)
+        if name == 'next_action_date':
+            return format_date(value)
+        return '' if value is None else str(value)
+    return _PLACEHOLDER.sub(field, template)
+
+
+def parse_case_id_file(data):
+    """Case ids from an uploaded file - first column of each line, header/blank lines skipped."""
+    ids = []
+    for line in data.decode('utf-8-sig', errors='replace').splitlines():
+        first = line.split(',')[0].strip().strip('"')
+        if first.isdigit():
+            ids.append(int(first))
+    return ids
+
+
+def bulk_add_notes(db, case_ids, note_type, template, user_id, run_id=None):
+    """Add one note per case. Returns (batch_id, notes written).
+    The batch_id is also the bulk_runs id, so progress can be polled while it runs."""
+    used = template_fields(template)
+    batch_id = run_id or uuid.uuid4().hex
+    columns = ", ".join(f"{NOTE_FIELDS[f]} AS {f}" for f in sorted(used - {'today'})) or "s.id AS case_id"
+    today = date.today().strftime('%d/%m/%Y')
+    c = db.cursor()
+    c.execute("INSERT INTO bulk_runs (id, kind, total, created_by) VALUES (%s, 'notes', %s, %s)",
+              (batch_id, len(case_ids), user_id))
+    db.commit()
+
+    written = 0
+    for chunk in _chunks(case_ids, BULK_NOTE_CHUNK_SIZE):
+        c.execute(f"""
+            SELECT s.id AS _id, {columns}
+            FROM cases s JOIN clients cl ON cl.id = s.client_id
+            WHERE s.id = ANY(%s)
+        """, (chunk,))
+        rows = c.fetchall()
+        with c.copy("COPY notes (case_id, type, note, created_by, batch_id) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row((row['_id'], note_type, _render(template, row, today), user_id, batch_id))
+        written += len(rows)
+        c.execute("UPDATE bulk_runs SET done = %s WHERE id = %s", (written, batch_id))
+        db.commit()
+
+    c.execute("UPDATE bulk_runs SET finished_at = CURRENT_TIMESTAMP WHERE id = %s", (batch_id,))
+    db.commit()
+    return batch_id, written
+
+
+def bulk_delete_notes(db, batch_id):
+    c = db.cursor()
+    c.execute("DELETE FROM notes WHERE batch_id = %s", (batch_id,))
+    db.commit()
+    return c.rowcount
+
+
+def bulk_run(db, run_id):
+    c = db.cursor()
+    c.execute("SELECT * FROM bulk_runs WHERE id = %s", (run_id,))
+    return c.fetchone()
+
+
+# ----------------------------------------------------------------------
+#  FORM ROUTES (client page)
+# ----------------------------------------------------------------------
+@bulk_bp.route('/bulk/status', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def bulk_status():
+    client_id = request.form.get('client_id', '')
+    if not client_id.isdigit():
+        return "No client specified", 400
+    db = get_db()
+    try:
+        if request.form.get('scope') == 'filter':
+            case_ids = resolve_case_ids(db, client_id=request.form.get('filter_client_id'),
+                                        status=request.form.get('filter_status'),
+                                        substatus=request.form.get('filter_substatus'))
+        else:
+            case_ids = resolve_case_ids(db, case_ids=request.form.getlist('case_ids'))
+    except ValueError as e:
+        return str(e), 400
+
+    if not case_ids:
+        flash("No cases selected")
+        return redirect(url_for('client.client_dashboard', client_id=client_id))
+
+    batch_id, updated = bulk_update_status(
+        db, case_ids,
+        request.form['status'],
+        request.form.get('substatus') or None,
+        request.form.get('next_action_date') or None,
+        current_user.id,
+    )
+    return redirect(url_for('client.client_dashboard', client_id=client_id, bulk_batch=batch_id, updated=updated))
+
+
+@bulk_bp.route('/bulk/status/undo/<batch_id>', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def bulk_status_undo(batch_id):
+    # checked before the undo - it is committed as soon as it runs
+    client_id = request.form.get('client_id', '')
+    if not client_id.isdigit():
+        return "No client specified", 400
+    reverted, skipped = bulk_undo_status(get_db(), batch_id)
+    flash(f"Undone on {reverted} cases" + (f" ({skipped} changed since, left alone)" if skipped else ""))
+    return redirect(url_for('client.client_dashboard', client_id=client_id))
+
+
+def _run_id(value):
+    # the page makes up the run id so it can poll progress while the POST runs
+    return value if value and re.fullmatch(r'[0-9a-f]{32}', value) else None
+
+
+@bulk_bp.route('/bulk/notes', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def bulk_notes():
+    client_id = request.form.get('client_id', '')
+    if not client_id.isdigit():
+        return "No client specified", 400
+    db = get_db()
+    scope = request.form.get('scope')
+    try:
+        if scope == 'filter':
+            case_ids = resolve_case_ids(db, client_id=request.form.get('filter_client_id'),
+                                        status=request.form.get('filter_status'),
+                                        substatus=request.form.get('filter_substatus'))
+        elif scope == 'upload':
+            upload = request.files.get('case_file')
+            case_ids = resolve_case_ids(db, case_ids=parse_case_id_file(upload.read()) if upload else [])
+        else:
+            case_ids = resolve_case_ids(db, case_ids=request.form.getlist('case_ids'))
+    except ValueError as e:
+        return str(e), 400
+
+    if not case_ids:
+        flash("No cases selected")
+        return redirect(url_for('client.client_dashboard', client_id=client_id))
+    try:
+        batch_id, written = bulk_add_notes(db, case_ids, request.form['type'], request.form['template'],
+                                           current_user.id, _run_id(request.form.get('run_id')))
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('client.client_dashboard', client_id=client_id))
+    return redirect(url_for('client.client_dashboard', client_id=client_id, note_batch=batch_id, notes_added=written))
+
+
+@bulk_bp.route('/bulk/notes/undo/<batch_id>', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def bulk_notes_undo(batch_id):
+    # checked before the delete - it is committed as soon as it runs
+    client_id = request.form.get('client_id', '')
+    if not client_id.isdigit():
+        return "No client specified", 400
+    flash(f"Removed {bulk_delete_notes(get_db(), batch_id)} notes")
+    return redirect(url_for('client.client_dashboard', client_id=client_id))
+
+
+# ----------------------------------------------------------------------
+#  JSON API
+#  POST /api/bulk/status  {"case_ids": [...]} or {"filter": {"client_id":..,"status":..,"substatus":..}}
+#                         + "status", optional "substatus", "next_action_date"
+#  POST /api/bulk/status/<batch_id>/undo
+#  POST /api/bulk/notes   {"case_ids": [...]} or {"filter": {...}} + "type", "template", optional "run_id"
+#  POST /api/bulk/notes/<batch_id>/undo
+#  GET  /api/bulk/runs/<run_id>   progress of a bulk note run
+# ----------------------------------------------------------------------
+@bulk_bp.route('/api/bulk/status', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def api_bulk_status():
+    data = request.get_json(silent=True) or {}
+    if not data.get('status'):
+        return jsonify({'error': 'status is required'}), 400
+
+    db = get_db()
+    filt = data.get('filter') or {}
+    try:
+        case_ids = resolve_case_ids(db, case_ids=data.get('case_ids'), client_id=filt.get('client_id'),
+                                    status=filt.get('status'), substatus=filt.get('substatus'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not case_ids:
+        return jsonify({'error': 'no matching cases'}), 400
+
+    batch_id, updated = bulk_update_status(db, case_ids, data['status'], data.get('substatus'),
+                                           data.get('next_action_date'), current_user.id)
+    return jsonify({'batch_id': batch_id, 'matched': len(case_ids), 'updated': updated})
+
+
+@bulk_bp.route('/api/bulk/status/<batch_id>/undo', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def api_bulk_status_undo(batch_id):
+    reverted, skipped = bulk_undo_status(get_db(), batch_id)
+    return jsonify({'batch_id': batch_id, 'reverted': reverted, 'skipped': skipped})
+
+
+@bulk_bp.route('/api/bulk/notes', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def api_bulk_notes():
+    data = request.get_json(silent=True) or {}
+    if not data.get('type') or not data.get('template'):
+        return jsonify({'error': 'type and template are required'}), 400
+
+    db = get_db()
+    filt = data.get('filter') or {}
+    try:
+        case_ids = resolve_case_ids(db, case_ids=data.get('case_ids'), client_id=filt.get('client_id'),
+                                    status=filt.get('status'), substatus=filt.get('substatus'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not case_ids:
+        return jsonify({'error': 'no matching cases'}), 400
+    try:
+        batch_id, written = bulk_add_notes(db, case_ids, data['type'], data['template'], current_user.id,
+                                           _run_id(data.get('run_id')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'batch_id': batch_id, 'matched': len(case_ids), 'written': written})
+
+
+@bulk_bp.route('/api/bulk/notes/<batch_id>/undo', methods=['POST'])
+@login_required
+@expensive('bulk')
+@query_budget(BULK_TIMEOUT_MS)
+def api_bulk_notes_undo(batch_id):
+    return jsonify({'batch_id': batch_id, 'deleted': bulk_delete_notes(get_db(), batch_id)})
+
+
+# not @expensive - it's polled while the run itself holds a bulk slot
+@bulk_bp.route('/api/bulk/runs/<run_id>')
+@login_required
+def api_bulk_run(run_id):
+    run = bulk_run(get_db(), run_id)
+    if not run:
+        return jsonify({'error': 'unknown run'}), 404
+    return jsonify({'id': run['id'], 'kind': run['kind'], 'total': run['total'], 'done': run['done'],
+                    'finished': run['finished_at'] is not None})
@@ -4,15 +4,28 @@
 #  • Add case, add transaction, add note
 #  • Edit / delete transaction & note
 #  • Update case status
-#  • Search (cases & clients)
+#  • Search (cases & clients) - the no-proxy fallback for autocomplete.py
 #  • The get_transaction endpoint for the edit modal
+#  • Case timeline - printable page + CSV for court bundles (timeline.py)
+#  The dashboard itself patches notes / transactions in place through the
+#  JSON case-panel API (routes/case_api.py) - the form routes here share its
+#  SQL and are the no-JavaScript fallback
 #  THIS FILE IS DELIBERATELY HUGE BECAUSE IT'S THE MAIN WORKFLOW
 #  Future dev: if you want to split this further later, go for it. For now it's all here and clearly labelled.
 # =============================================================================
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort,
+                   Response, stream_template, stream_with_context)
 from flask_login import login_required, current_user
 from extensions import get_db
+from archive import source, restore_if_archived, case_of
+from fragment_cache import LazyRows, bump, load_versions, version_name
+from balances import to_pence, pounds
+from autocomplete import LOOKUPS, lookup_params
+from timeline import iter_timeline, stream_timeline_csv
+from dedupe import index_cases, find_duplicates_of_case, find_duplicates_of_values
+from routes.case_api import (case_totals, case_notes, case_transactions, insert_note, update_note,
+                             insert_transaction, update_transaction, change_status)
 from datetime import date
 
 case_bp = Blueprint('case', __name__)
@@ -24,48 +37,24 @@ case_bp = Blueprint('case', __name__)
 @case_bp.route('/search')
 @login_required
 def search():
-    q = request.args.get('q', '').strip().lower()
-    if not q:
-        return jsonify([])
-
-    db = get_db()
-    c = db.cursor()
-    like = f"%{q}%"
-
-    sql = """
-        SELECT DISTINCT
-            c.id as client_id, c.business_name as client_name,
-            s.id as case_id,
-            COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last) as debtor_name,
-            s.postcode, s.email, s.phone
-        FROM cases s
-        JOIN clients c ON s.client_id = c.id
-        WHERE LOWER(c.business_name) LIKE %s
-           OR LOWER(COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last)) LIKE %s
-           OR LOWER(s.email || '') LIKE %s
-           OR LOWER(s.phone || '') LIKE %s
-           OR LOWER(s.postcode || '') LIKE %s
-        ORDER BY c.business_name, s.id
-        LIMIT 50
-    """
-    c.execute(sql, (like, like, like, like, like))
-    results = [dict(row) for row in c.fetchall()]
-    return jsonify(results)
+    return jsonify(_lookup('/search'))
 
 
 @case_bp.route('/client_search')
 @login_required
 def client_search():
+    return jsonify(_lookup('/client_search'))
+
+
+def _lookup(path):
+    # Sync fallback - in production the proxy sends these two to autocomplete.py,
+    # which runs the same SQL with cancellation, caching and a latency budget
     q = request.args.get('q', '').strip()
     if not q:
-        return jsonify([])
-
-    db = get_db()
-    c = db.cursor()
-    like = f"%{q.lower()}%"
-    c.execute("SELECT id, business_name as name FROM clients WHERE LOWER(business_name) LIKE %s ORDER BY business_name LIMIT 20", (like,))
-    results = [{'id': r['id'], 'name': r['name']} for r in c.fetchall()]
-    return jsonify(results)
+        return []
+    c = get_db().cursor()
+    c.execute(LOOKUPS[path][0], lookup_params(path, q))
+    return [dict(row) for row in c.fetchall()]
 
 
 # ----------------------------------------------------------------------
@@ -91,33 +80,51 @@ def add_case():
         request.form['next_action_date']
     ))
     new_case_id = c.fetchone()['id']
+    index_cases(db, [new_case_id])
+    bump(db, 'recent_cases', version_name('client_cases', request.form['client_id']))
     db.commit()
     flash('Case added')
+
+    duplicates = find_duplicates_of_case(db, new_case_id)
+    if duplicates:
+        flash("Possible duplicate of " + ", ".join(
+            f"case #{d['case_id']} ({d['debtor_name']}, same {'/'.join(d['matched_on'])})" for d in duplicates[:5]))
     return redirect(url_for('case.dashboard', case_id=new_case_id))
 
 
+# Called by the Add Case modal while the user types, before anything is saved
+@case_bp.route('/check_duplicates')
+@login_required
+def check_duplicates():
+    if not request.args.get('client_id'):
+        return jsonify([])
+    return jsonify(find_duplicates_of_values(
+        get_db(),
+        request.args['client_id'],
+        request.args.get('debtor_business_name', ''),
+        request.args.get('debtor_first', ''),
+        request.args.get('debtor_last', ''),
+        request.args.get('phone', ''),
+        request.args.get('email', ''),
+        request.args.get('postcode', ''),
+    )[:10])
+
+
 @case_bp.route('/add_transaction', methods=['POST'])
 @login_required
 def add_transaction():
     db = get_db()
-    c = db.cursor()
-    trans_date = request.form.get('transaction_date') or date.today().isoformat()
     recoverable = 1 if request.form.get('recoverable') else 0
     billable = 1 if request.form.get('billable') else 0
-
-    c.execute('''
-        INSERT INTO money (case_id, type, amount, created_by, description, transaction_date, recoverable, billable)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (
-        request.form['case_id'],
-        request.form['type'],
-        request.form['amount'],
-        current_user.id,
-        request.form.get('note', ''),
-        trans_date,
-        recoverable,
-        billable
-    ))
+    try:
+        amount_pence = to_pence(request.form['amount'])
+    except ValueError:
+        flash("Amount must be a number, e.g. 125.50")
+        return redirect(url_for('case.dashboard', case_id=request.form['case_id']))
+
+    insert_transaction(db, request.form['case_id'], request.form['type'], amount_pence,
+                       current_user.id, request.form.get('note', ''),
+                       request.form.get('transaction_date'), recoverable, billable)
     db.commit()
     return redirect(url_for('case.dashboard', case_id=request.form['case_id']))
 
@@ -126,16 +133,7 @@ def add_transaction():
 @login_required
 def add_note():
     db = get_db()
-    c = db.cursor()
-    c.execute('''
-        INSERT INTO notes (case_id, type, note, created_by)
-        VALUES (%s, %s, %s, %s)
-    ''', (
-        request.form['case_id'],
-        request.form['type'],
-        request.form['note'],
-        current_user.id
-    ))
+    insert_note(db, request.form['case_id'], request.form['type'], request.form['note'], current_user.id)
     db.commit()
     return redirect(url_for('case.dashboard', case_id=request.form['case_id']))
 
@@ -148,14 +146,15 @@ def add_note():
 def get_transaction(trans_id):
     db = get_db()
     c = db.cursor()
-    c.execute("""
-        SELECT id, type, amount, description, recoverable, billable
-        FROM money WHERE id = %s
+    c.execute(f"""
+        SELECT id, type, amount_pence, description, recoverable, billable
+        FROM {source('money', True)} WHERE id = %s
     """, (trans_id,))
     trans = c.fetchone()
     if not trans:
         return jsonify({}), 404
     data = dict(trans)
+    data['amount'] = str(pounds(data['amount_pence']))  # the edit form takes pounds
     data['note'] = data.get('description') or ''  # backward compat for JS
     return jsonify(data)
 
@@ -164,21 +163,19 @@ def get_transaction(trans_id):
 @login_required
 def edit_transaction():
     db = get_db()
-    c = db.cursor()
     recoverable = 1 if request.form.get('recoverable') else 0
     billable = 1 if request.form.get('billable') else 0
+    try:
+        amount_pence = to_pence(request.form['amount'])
+    except ValueError:
+        flash("Amount must be a number, e.g. 125.50")
+        return redirect(url_for('case.dashboard', case_id=request.form.get('case_id') or ''))
 
-    c.execute('''
-        UPDATE money 
-        SET amount = %s, description = %s, recoverable = %s, billable = %s
-        WHERE id = %s
-    ''', (
-        request.form['amount'],
-        request.form.get('note', ''),
-        recoverable,
-        billable,
-        request.form['trans_id']
-    ))
+    case_id = case_of(db, 'money', request.form['trans_id'])
+    if case_id:
+        restore_if_archived(db, case_id)
+    update_transaction(db, request.form['trans_id'], amount_pence, request.form.get('note', ''),
+                       recoverable, billable)
     db.commit()
     return redirect(url_for('case.dashboard', case_id=request.form.get('case_id') or ''))
 
@@ -187,6 +184,9 @@ def edit_transaction():
 @login_required
 def delete_transaction(trans_id):
     db = get_db()
+    case_id = case_of(db, 'money', trans_id)
+    if case_id:
+        restore_if_archived(db, case_id)
     c = db.cursor()
     c.execute("DELETE FROM money WHERE id = %s", (trans_id,))
     db.commit()
@@ -197,9 +197,10 @@ def delete_transaction(trans_id):
 @login_required
 def edit_note():
     db = get_db()
-    c = db.cursor()
-    c.execute("UPDATE notes SET type = %s, note = %s WHERE id = %s", 
-              (request.form['type'], request.form['note'], request.form['note_id']))
+    case_id = case_of(db, 'notes', request.form['note_id'])
+    if case_id:
+        restore_if_archived(db, case_id)
+    update_note(db, request.form['note_id'], request.form['type'], request.form['note'])
     db.commit()
     return redirect(url_for('case.dashboard', case_id=request.form.get('case_id') or ''))
 
@@ -208,6 +209,9 @@ def edit_note():
 @login_required
 def delete_note(note_id):
     db = get_db()
+    case_id = case_of(db, 'notes', note_id)
+    if case_id:
+        restore_if_archived(db, case_id)
     c = db.cursor()
     c.execute("DELETE FROM notes WHERE id = %s", (note_id,))
     db.commit()
@@ -226,32 +230,7 @@ def update_case_status():
     new_next_action_date = request.form.get('next_action_date') or None   # <-- NEW
 
     db = get_db()
-    c = db.cursor()
-
-    # Get current values for history
-    c.execute("SELECT status, substatus, next_action_date FROM cases WHERE id = %s", (case_id,))
-    old = c.fetchone()
-
-    # Update the case (including next_action_date)
-    c.execute("""
-        UPDATE cases 
-        SET status = %s, 
-            substatus = %s, 
-            next_action_date = %s 
-        WHERE id = %s
-    """, (new_status, new_substatus, new_next_action_date, case_id))
-
-    # Record the change in history (only if something actually changed)
-    if (old['status'] != new_status or 
-        old['substatus'] != new_substatus or 
-        old['next_action_date'] != new_next_action_date):
-        
-        c.execute('''
-            INSERT INTO case_status_history 
-            (case_id, old_status, old_substatus, new_status, new_substatus, changed_by)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (case_id, old['status'], old['substatus'], new_status, new_substatus, current_user.id))
-
+    change_status(db, case_id, new_status, new_substatus, new_next_action_date, current_user.id)
     db.commit()
     return redirect(url_for('case.dashboard', case_id=case_id))
 
@@ -261,6 +240,8 @@ def update_case_status():
 def undo_status(case_id):
     db = get_db()
     c = db.cursor()
+    # an archived case's last change is in the archive - bring it back to undo it
+    restore_if_archived(db, case_id)
 
     # Get the most recent status change
     c.execute("""
@@ -300,12 +281,51 @@ def undo_status(case_id):
         )
     """, (case_id,))
 
+    c.execute("SELECT client_id FROM cases WHERE id = %s", (case_id,))
+    bump(db, version_name('client_cases', c.fetchone()['client_id']), version_name('case_history', case_id))
     db.commit()
     flash("Status successfully undone", "success")
 
     return redirect(url_for('case.dashboard', case_id=case_id))
 
 
+# ----------------------------------------------------------------------
+#  CASE TIMELINE - every note, transaction and status change, oldest first.
+#  Both stream a page of events at a time, however long the case is.
+# ----------------------------------------------------------------------
+def _timeline_case(db, case_id):
+    c = db.cursor()
+    c.execute('''
+        SELECT s.*, cl.business_name AS client_name
+        FROM cases s JOIN clients cl ON cl.id = s.client_id
+        WHERE s.id = %s
+    ''', (case_id,))
+    case = c.fetchone()
+    if not case:
+        abort(404)
+    return case
+
+
+@case_bp.route('/case/<int:case_id>/timeline')
+@login_required
+def case_timeline(case_id):
+    db = get_db()
+    case = _timeline_case(db, case_id)
+    events = iter_timeline(db, case_id, case['archived_at'] is not None)
+    return stream_template('case_timeline.html', case=case, events=events,
+                           printed_at=date.today())
+
+
+@case_bp.route('/case/<int:case_id>/timeline.csv')
+@login_required
+def case_timeline_csv(case_id):
+    db = get_db()
+    case = _timeline_case(db, case_id)
+    return Response(
+        stream_with_context(stream_timeline_csv(db, case_id, case['archived_at'] is not None)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=case_{case_id}_timeline.csv'},
+    )
 
 
 # ----------------------------------------------------------------------
@@ -318,12 +338,19 @@ def dashboard():
     db = get_db()
     c = db.cursor()
 
+    # The client dropdown, recent cases, sibling cases and status history are
+    # cached fragments in dashboard.html - their queries are LazyRows so they
+    # only run when the fragment has to be re-rendered (see fragment_cache.py)
+    def fetch(sql, params=()):
+        cur = db.cursor()
+        cur.execute(sql, params)
+        return cur.fetchall()
+
     # All clients for the sidebar
-    c.execute("SELECT id, business_name FROM clients ORDER BY business_name")
-    clients = c.fetchall()
+    clients = LazyRows(lambda: fetch("SELECT id, business_name FROM clients ORDER BY business_name"))
 
     # Recent cases for the "no case selected" view
-    c.execute("""
+    recent_cases = LazyRows(lambda: fetch("""
         SELECT c.id as client_id, c.business_name, s.id as case_id,
                COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last) as debtor,
                s.open_date
@@ -331,8 +358,8 @@ def dashboard():
         JOIN clients c ON s.client_id = c.id
         ORDER BY s.open_date DESC, s.id DESC
         LIMIT 10
-    """)
-    recent_cases = c.fetchall()
+    """))
+    load_versions(['client_options', 'recent_cases'])
 
     # Selected case logic
     selected_case = None
@@ -341,10 +368,9 @@ def dashboard():
     notes = []
     transactions = []
     status_history = []
-    balance = 0.0
+    balance = 0
     totals = {'Invoice': 0, 'Payment': 0, 'Charge': 0, 'Interest': 0}
     page = int(request.args.get('page', 1))
-    per_page = 15
 
     case_id = request.args.get('case_id')
     if case_id:
@@ -359,39 +385,26 @@ def dashboard():
             c.execute("SELECT * FROM clients WHERE id = %s", (selected_case['client_id'],))
             case_client = c.fetchone()
 
-            c.execute("SELECT id, debtor_business_name, debtor_first, debtor_last FROM cases WHERE client_id = %s ORDER BY id", (selected_case['client_id'],))
-            client_cases = c.fetchall()
-
-            offset = (page - 1) * per_page
-            c.execute('''
-                SELECT n.*, u.username FROM notes n JOIN users u ON n.created_by = u.id 
-                WHERE n.case_id = %s ORDER BY n.created_at DESC LIMIT %s OFFSET %s
-            ''', (case_id, per_page, offset))
-            notes = c.fetchall()
-
-            c.execute('''
-                SELECT m.*, u.username FROM money m JOIN users u ON m.created_by = u.id 
-                WHERE m.case_id = %s ORDER BY m.transaction_date ASC, m.id ASC LIMIT %s OFFSET %s
-            ''', (case_id, per_page, offset))
-            transactions = c.fetchall()
-
-            c.execute('''
-                SELECT h.*, u.username FROM case_status_history h 
-                JOIN users u ON h.changed_by = u.id 
+            client_cases = LazyRows(lambda: fetch(
+                "SELECT id, debtor_business_name, debtor_first, debtor_last, status FROM cases WHERE client_id = %s ORDER BY id",
+                (selected_case['client_id'],)))
+
+            # Archived cases read their history from the live + archive views
+            archived = selected_case['archived_at'] is not None
+
+            notes = case_notes(db, case_id, archived, page)
+            transactions = case_transactions(db, case_id, archived, page)
+            # totals / balance over every transaction, not just this page
+            totals, balance = case_totals(db, case_id, archived)
+
+            status_history = LazyRows(lambda: fetch(f'''
+                SELECT h.*, u.username FROM {source('case_status_history', archived)} h
+                JOIN users u ON h.changed_by = u.id
                 WHERE h.case_id = %s ORDER BY h.changed_at DESC
-            ''', (case_id,))
-            status_history = c.fetchall()
-
-            for t in transactions:
-                amt = float(t['amount'])
-                typ = t['type']
-                if typ == 'Payment':
-                    balance -= amt
-                elif typ in ['Invoice', 'Interest']:
-                    balance += amt
-                elif typ == 'Charge' and t['recoverable']:
-                    balance += amt
-                totals[typ] += amt
+            ''', (case_id,)))
+
+            load_versions([version_name('client_cases', selected_case['client_id']),
+                           version_name('case_history', case_id)])
 
     today_str = date.today().isoformat()
 
@@ -404,7 +417,7 @@ def dashboard():
                            notes=notes,
                            transactions=transactions,
                            status_history=status_history,
-                           balance=round(balance, 2),
-                           totals={k: round(v, 2) for k, v in totals.items()},
+                           balance=balance,
+                           totals=totals,
                            today_str=today_str,
                            page=page)
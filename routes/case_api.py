@@ -0,0 +1,388 @@
+# =============================================================================
+#  CASE PANEL API - THE DASHBOARD'S CASE PANEL AS JSON
+#  • Each part of the panel can be fetched on its own: header (case, client,
+#    status, totals), notes, transactions and status history - or all three
+#    merged as one keyset-paged timeline (timeline.py)
+#  • Writes (add / edit / delete note & transaction, status change) answer
+#    with the record they touched plus its rendered table row, so the page
+#    patches itself in place instead of reloading the whole dashboard
+#  • The SQL for every write lives here once - the old form routes in
+#    routes/case.py call the same functions and still redirect
+#  Everything is under /api/case/<case_id>/..., login required.
+#  Bodies can be JSON or form-encoded. Money goes out as integer pence
+#  (amount_pence, totals, balance) plus amount as an exact pounds string;
+#  it comes in as amount (pounds) or amount_pence.
+# =============================================================================
+
+from datetime import date, datetime
+from flask import Blueprint, request, jsonify, render_template, abort
+from flask_login import login_required, current_user
+from extensions import get_db
+from archive import source, restore_case, restore_if_archived
+from fragment_cache import bump, version_name
+from timeline import timeline_page, TIMELINE_PAGE_SIZE
+from balances import TYPES as TRANSACTION_TYPES, totals_columns, to_pence, pounds
+
+case_api_bp = Blueprint('case_api', __name__, url_prefix='/api/case')
+
+PER_PAGE = 15
+NOTE_TYPES = ('General', 'Inbound Call', 'Outbound Call', 'Email Sent', 'Email Received', 'Letter Sent')
+
+
+def _json(row):
+    """A DB row as something jsonify copes with - dates as ISO strings, pence also as pounds."""
+    out = dict(row)
+    for k, v in out.items():
+        if isinstance(v, (date, datetime)):
+            out[k] = v.isoformat()
+    if out.get('amount_pence') is not None:
+        out['amount'] = str(pounds(out['amount_pence']))
+    return out
+
+
+def _body():
+    return request.get_json(silent=True) or request.form
+
+
+def _flag(value):
+    return 1 if value and str(value).lower() not in ('0', 'false', 'off') else 0
+
+
+def _amount_pence(data):
+    """amount_pence if given, else amount in pounds. ValueError if neither is an amount."""
+    if data.get('amount_pence') not in (None, ''):
+        pence = data['amount_pence']
+        if isinstance(pence, float) or not str(pence).lstrip('-').isdigit():
+            raise ValueError("amount_pence must be a whole number")
+        return int(pence)
+    return to_pence(data.get('amount'))
+
+
+# ----------------------------------------------------------------------
+#  READS
+# ----------------------------------------------------------------------
+def get_case(db, case_id):
+    c = db.cursor()
+    c.execute("SELECT * FROM cases WHERE id = %s", (case_id,))
+    return c.fetchone()
+
+
+def case_totals(db, case_id, archived=False):
+    """Per-type totals and the balance, in pence, over ALL the case's transactions (one aggregate)."""
+    c = db.cursor()
+    c.execute(f"""
+        SELECT {totals_columns('m')}
+        FROM {source('money', archived)} m
+        WHERE m.case_id = %s
+    """, (case_id,))
+    row = c.fetchone()
+    return {t: row[f'{t.lower()}_pence'] for t in TRANSACTION_TYPES}, row['balance_pence']
+
+
+def case_notes(db, case_id, archived=False, page=1):
+    c = db.cursor()
+    c.execute(f'''
+        SELECT n.*, u.username FROM {source('notes', archived)} n JOIN users u ON n.created_by = u.id
+        WHERE n.case_id = %s ORDER BY n.created_at DESC LIMIT %s OFFSET %s
+    ''', (case_id, PER_PAGE, (page - 1) * PER_PAGE))
+    return c.fetchall()
+
+
+def case_transactions(db, case_id, archived=False, page=1):
+    c = db.cursor()
+    c.execute(f'''
+        SELECT m.*, u.username FROM {source('money', archived)} m JOIN users u ON m.created_by = u.id
+        WHERE m.case_id = %s ORDER BY m.transaction_date ASC, m.id ASC LIMIT %s OFFSET %s
+    ''', (case_id, PER_PAGE, (page - 1) * PER_PAGE))
+    return c.fetchall()
+
+
+def case_history(db, case_id, archived=False):
+    c = db.cursor()
+    c.execute(f'''
+        SELECT h.*, u.username FROM {source('case_status_history', archived)} h
+        JOIN users u ON h.changed_by = u.id
+        WHERE h.case_id = %s ORDER BY h.changed_at DESC
+    ''', (case_id,))
+    return c.fetchall()
+
+
+def _header(db, case):
+    c = db.cursor()
+    c.execute("SELECT id, business_name FROM clients WHERE id = %s", (case['client_id'],))
+    totals, balance = case_totals(db, case['id'], case['archived_at'] is not None)
+    return {'case': _json(case), 'client': _json(c.fetchone()), 'totals': totals, 'balance': balance}
+
+
+# ----------------------------------------------------------------------
+#  WRITES - caller commits
+# ----------------------------------------------------------------------
+def insert_note(db, case_id, note_type, note, user_id):
+    c = db.cursor()
+    c.execute('''
+        INSERT INTO notes (case_id, type, note, created_by)
+        VALUES (%s, %s, %s, %s) RETURNING *
+    ''', (case_id, note_type, note, user_id))
+    return c.fetchone()
+
+
+def update_note(db, note_id, note_type, note, case_id=None):
+    c = db.cursor()
+    c.execute("""
+        UPDATE notes SET type = %s, note = %s
+        WHERE id = %s AND (%s::int IS NULL OR case_id = %s::int) RETURNING *
+    """, (note_type, note, note_id, case_id, case_id))
+    return c.fetchone()
+
+
+def insert_transaction(db, case_id, trans_type, amount_pence, user_id, description='', transaction_date=None,
+                       recoverable=0, billable=0):
+    c = db.cursor()
+    c.execute('''
+        INSERT INTO money (case_id, type, amount_pence, created_by, description, transaction_date, recoverable, billable)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING *
+    ''', (case_id, trans_type, amount_pence, user_id, description,
+          transaction_date or date.today().isoformat(), recoverable, billable))
+    return c.fetchone()
+
+
+def update_transaction(db, trans_id, amount_pence, description, recoverable, billable, case_id=None):
+    c = db.cursor()
+    c.execute('''
+        UPDATE money
+        SET amount_pence = %s, description = %s, recoverable = %s, billable = %s
+        WHERE id = %s AND (%s::int IS NULL OR case_id = %s::int) RETURNING *
+    ''', (amount_pence, description, recoverable, billable, trans_id, case_id, case_id))
+    return c.fetchone()
+
+
+def change_status(db, case_id, new_status, new_substatus, new_next_action_date, user_id):
+    """Set status / substatus / next action date, recording history if anything changed.
+    Returns the updated case row."""
+    c = db.cursor()
+    c.execute("SELECT client_id, status, substatus, next_action_date, archived_at FROM cases WHERE id = %s", (case_id,))
+    old = c.fetchone()
+    if not old:
+        return None
+
+    # Re-opening an archived case brings its history back into the live tables
+    if old['archived_at'] and new_status != 'Closed':
+        restore_case(db, case_id)
+
+    c.execute("""
+        UPDATE cases
+        SET status = %s,
+            substatus = %s,
+            next_action_date = %s
+        WHERE id = %s RETURNING *
+    """, (new_status, new_substatus, new_next_action_date, case_id))
+    case = c.fetchone()
+
+    # next_action_date is TEXT in cases and comes in as a string - compare the strings ('' = none)
+    if (old['status'] != new_status or
+            old['substatus'] != new_substatus or
+            (old['next_action_date'] or None) != new_next_action_date):
+        c.execute('''
+            INSERT INTO case_status_history
+            (case_id, old_status, old_substatus, new_status, new_substatus, changed_by)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (case_id, old['status'], old['substatus'], new_status, new_substatus, user_id))
+
+    bump(db, version_name('client_cases', old['client_id']), version_name('case_history', case_id))
+    return case
+
+
+# ----------------------------------------------------------------------
+#  GET - one part of the panel each
+# ----------------------------------------------------------------------
+def _case_or_404(db, case_id):
+    case = get_case(db, case_id)
+    if not case:
+        abort(404)
+    return case
+
+
+def _page():
+    return max(1, request.args.get('page', 1, type=int))
+
+
+@case_api_bp.route('/<int:case_id>')
+@login_required
+def header(case_id):
+    db = get_db()
+    return jsonify(_header(db, _case_or_404(db, case_id)))
+
+
+@case_api_bp.route('/<int:case_id>/notes')
+@login_required
+def notes(case_id):
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    page = _page()
+    rows = case_notes(db, case_id, case['archived_at'] is not None, page)
+    return jsonify({'page': page, 'per_page': PER_PAGE, 'notes': [_json(r) for r in rows]})
+
+
+@case_api_bp.route('/<int:case_id>/transactions')
+@login_required
+def transactions(case_id):
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    archived = case['archived_at'] is not None
+    page = _page()
+    rows = case_transactions(db, case_id, archived, page)
+    totals, balance = case_totals(db, case_id, archived)
+    return jsonify({'page': page, 'per_page': PER_PAGE, 'transactions': [_json(r) for r in rows],
+                    'totals': totals, 'balance': balance})
+
+
+@case_api_bp.route('/<int:case_id>/history')
+@login_required
+def history(case_id):
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    rows = case_history(db, case_id, case['archived_at'] is not None)
+    return jsonify({'history': [_json(r) for r in rows]})
+
+
+@case_api_bp.route('/<int:case_id>/timeline')
+@login_required
+def timeline(case_id):
+    """?after=<next from the previous page>&limit=N (max TIMELINE_PAGE_SIZE), oldest first."""
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    limit = min(max(1, request.args.get('limit', 100, type=int)), TIMELINE_PAGE_SIZE)
+    try:
+        events, after = timeline_page(db, case_id, case['archived_at'] is not None,
+                                      request.args.get('after') or None, limit)
+    except ValueError:
+        return jsonify({'error': 'bad cursor'}), 400
+    return jsonify({'events': [_json(e) for e in events], 'next': after})
+
+
+# ----------------------------------------------------------------------
+#  WRITES - answer with the record and its rendered row
+# ----------------------------------------------------------------------
+def _note_response(note, status=200):
+    note = dict(note, username=current_user.username)
+    return jsonify({'note': _json(note), 'html': render_template('_note_row.html', n=note)}), status
+
+
+def _transaction_response(db, case, trans, status=200):
+    trans = dict(trans, username=current_user.username)
+    totals, balance = case_totals(db, case['id'], case['archived_at'] is not None)
+    return jsonify({'transaction': _json(trans), 'html': render_template('_transaction_row.html', t=trans),
+                    'totals': totals, 'balance': balance}), status
+
+
+@case_api_bp.route('/<int:case_id>/notes', methods=['POST'])
+@login_required
+def add_note(case_id):
+    data = _body()
+    if data.get('type') not in NOTE_TYPES or not (data.get('note') or '').strip():
+        return jsonify({'error': 'type and note are required'}), 400
+    db = get_db()
+    _case_or_404(db, case_id)
+    note = insert_note(db, case_id, data['type'], data['note'], current_user.id)
+    db.commit()
+    return _note_response(note, 201)
+
+
+@case_api_bp.route('/<int:case_id>/notes/<int:note_id>', methods=['PATCH', 'PUT'])
+@login_required
+def edit_note(case_id, note_id):
+    data = _body()
+    if data.get('type') not in NOTE_TYPES or not (data.get('note') or '').strip():
+        return jsonify({'error': 'type and note are required'}), 400
+    db = get_db()
+    restore_if_archived(db, case_id)
+    note = update_note(db, note_id, data['type'], data['note'], case_id)
+    if not note:
+        abort(404)
+    db.commit()
+    return _note_response(note)
+
+
+@case_api_bp.route('/<int:case_id>/notes/<int:note_id>', methods=['DELETE'])
+@login_required
+def delete_note(case_id, note_id):
+    db = get_db()
+    restore_if_archived(db, case_id)
+    c = db.cursor()
+    c.execute("DELETE FROM notes WHERE id = %s AND case_id = %s", (note_id, case_id))
+    if not c.rowcount:
+        abort(404)
+    db.commit()
+    return '', 204
+
+
+@case_api_bp.route('/<int:case_id>/transactions', methods=['POST'])
+@login_required
+def add_transaction(case_id):
+    data = _body()
+    try:
+        amount_pence = _amount_pence(data)
+    except ValueError:
+        amount_pence = None
+    if data.get('type') not in TRANSACTION_TYPES or amount_pence is None:
+        return jsonify({'error': 'type and amount are required'}), 400
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    trans = insert_transaction(db, case_id, data['type'], amount_pence, current_user.id,
+                               data.get('note', data.get('description', '')),
+                               data.get('transaction_date') or None,
+                               _flag(data.get('recoverable')), _flag(data.get('billable')))
+    db.commit()
+    return _transaction_response(db, case, trans, 201)
+
+
+@case_api_bp.route('/<int:case_id>/transactions/<int:trans_id>', methods=['PATCH', 'PUT'])
+@login_required
+def edit_transaction(case_id, trans_id):
+    data = _body()
+    try:
+        amount_pence = _amount_pence(data)
+    except ValueError:
+        return jsonify({'error': 'amount is required'}), 400
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    if restore_if_archived(db, case_id):
+        case = get_case(db, case_id)
+    trans = update_transaction(db, trans_id, amount_pence, data.get('note', data.get('description', '')),
+                               _flag(data.get('recoverable')), _flag(data.get('billable')), case_id)
+    if not trans:
+        abort(404)
+    db.commit()
+    return _transaction_response(db, case, trans)
+
+
+@case_api_bp.route('/<int:case_id>/transactions/<int:trans_id>', methods=['DELETE'])
+@login_required
+def delete_transaction(case_id, trans_id):
+    db = get_db()
+    case = _case_or_404(db, case_id)
+    if restore_if_archived(db, case_id):
+        case = get_case(db, case_id)
+    c = db.cursor()
+    c.execute("DELETE FROM money WHERE id = %s AND case_id = %s", (trans_id, case_id))
+    if not c.rowcount:
+        abort(404)
+    db.commit()
+    totals, balance = case_totals(db, case_id, case['archived_at'] is not None)
+    return jsonify({'totals': totals, 'balance': balance})
+
+
+@case_api_bp.route('/<int:case_id>/status', methods=['POST'])
+@login_required
+def update_status(case_id):
+    data = _body()
+    if not data.get('status'):
+        return jsonify({'error': 'status is required'}), 400
+    db = get_db()
+    case = change_status(db, case_id, data['status'], data.get('substatus') or None,
+                         data.get('next_action_date') or None, current_user.id)
+    if not case:
+        abort(404)
+    db.commit()
+    return jsonify({**_header(db, case),
+                    'history': [_json(r) for r in case_history(db, case_id, case['archived_at'] is not None)]})
@@ -8,6 +8,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required
 from extensions import get_db
+from archive import source
+from balances import case_balances
+from fragment_cache import bump
 
 client_bp = Blueprint('client', __name__, url_prefix='/client')
 
@@ -35,18 +38,10 @@ def client_dashboard(client_id):
     """, (client_id,))
     cases = c.fetchall()
 
-    # Calculate balance for each case
+    # Balance for each case, in pence - one query for all of them
+    balances = case_balances(db, source('money', any(case['archived_at'] for case in cases)), [case['id'] for case in cases])
     for case in cases:
-        c.execute("SELECT type, amount, recoverable FROM money WHERE case_id = %s", (case['id'],))
-        balance = 0.0
-        for t in c.fetchall():
-            if t['type'] == 'Payment':
-                balance -= t['amount']
-            elif t['type'] in ['Invoice', 'Interest']:
-                balance += t['amount']
-            elif t['type'] == 'Charge' and t['recoverable']:
-                balance += t['amount']
-        case['balance'] = round(balance, 2)
+        case['balance'] = balances[case['id']]
 
     return render_template('client_dashboard.html', client=client, cases=cases)
 
@@ -70,6 +65,7 @@ def add_client():
         request.form['bacs_details'],
         request.form.get('default_interest_rate', 0)
     ))
+    bump(db, 'client_options')
     db.commit()
     flash('Client added')
     return redirect(url_for('case.dashboard'))
@@ -90,21 +86,12 @@ def client_cases(client_id):
         flash("Client not found")
         return redirect(url_for('case.dashboard'))
 
-    c.execute("SELECT id, debtor_business_name, debtor_first, debtor_last, status, open_date FROM cases WHERE client_id = %s ORDER BY open_date DESC", (client_id,))
+    c.execute("SELECT id, debtor_business_name, debtor_first, debtor_last, status, open_date, archived_at FROM cases WHERE client_id = %s ORDER BY open_date DESC", (client_id,))
     cases = c.fetchall()
 
-    # Calculate balance for each case
+    # Balance for each case, in pence - one query for all of them
+    balances = case_balances(db, source('money', any(case['archived_at'] for case in cases)), [case['id'] for case in cases])
     for case in cases:
-        c.execute("SELECT type, amount, recoverable FROM money WHERE case_id = %s", (case['id'],))
-        bal = 0.0
-        for t in c.fetchall():
-            amt = float(t['amount'] or 0)
-            if t['type'] == 'Payment':
-                bal -= amt
-            elif t['type'] in ['Invoice', 'Interest']:
-                bal += amt
-            elif t['type'] == 'Charge' and t['recoverable']:
-                bal += amt
-        case['balance'] = round(bal, 2)
+        case['balance'] = balances[case['id']]
 
     return render_template('client_cases.html', client=client, cases=cases)
@@ -2,26 +2,61 @@
 #  REPORTS ROUTES
 #  • Export client data to Excel
 #  • Export client data to PDF
+#  • /statement – one client's period statement PDF (statements.py; the
+#    month-end batch for every client is `flask --app app statements run`)
 #  • /report page – the proper report screen with preview + export buttons
+#  • Nightly balance snapshots + aged debt (flask --app app reports nightly)
+#  • /report/aged_debt and /report/trend – served from the snapshot tables
+#    and aged_debt_mv, never from the raw ledger
+#  /report and the exports get a longer query budget and share the 'reports'
+#  concurrency slots (load_limits.py); the snapshot pages are cheap and
+#  stay interactive
 # =============================================================================
 
+import click
+from datetime import date, timedelta
 from flask import Blueprint, request, send_file, make_response, render_template
+from flask.cli import AppGroup
 from flask_login import login_required
 from extensions import get_db
-import pandas as pd
+from load_limits import query_budget, expensive, REPORT_TIMEOUT_MS
+from archive import source
+from balances import load_case_totals, totals_columns, format_money, pounds, TOTAL_COLUMNS
+from statements import iter_statement_data, statement_pdf, statement_filename
 from io import BytesIO
-from weasyprint import HTML
+
+# NOTE: pandas and WeasyPrint are imported inside the export functions, not here.
+# They add a lot of start-up time and memory to every gunicorn worker and only a
+# handful of requests ever export anything.
 
 reports_bp = Blueprint('reports', __name__)
 
 
+def _client_cases(include_archived):
+    # archived cases only have money in money_all - leave them out unless it's being read
+    return "s.client_id = %s" if include_archived else "s.client_id = %s AND s.archived_at IS NULL"
+
+
+def _report_table(totals, style):
+    """The per-case table shared by the report page and the PDF (amounts in pence)."""
+    html = f"<table border='1' style='width:100%; border-collapse:collapse; font-family:Arial; {style}'><tr style='background:#ddd;'><th>Case ID</th><th>Debtor</th><th>Invoice</th><th>Payment</th><th>Charge</th><th>Interest</th><th>Balance</th></tr>"
+    for d in totals.rows():
+        html += f"<tr><td>{d['case_id']}</td><td>{d['debtor']}</td>" + "".join(f"<td>{format_money(d[k])}</td>" for k in TOTAL_COLUMNS) + "</tr>"
+    grand = totals.grand()
+    html += "<tr style='font-weight:bold; background:#eee;'><td colspan='2'>TOTALS</td>" + "".join(f"<td>{format_money(grand[k])}</td>" for k in TOTAL_COLUMNS) + "</tr></table>"
+    return html
+
+
 # ----------------------------------------------------------------------
 #  1. The actual report page – shows table on screen + export buttons
 # ----------------------------------------------------------------------
 @reports_bp.route('/report')
 @login_required
+@expensive('reports', when=lambda: request.args.get('client_code'))
+@query_budget(REPORT_TIMEOUT_MS)
 def report_page():
     client_code = request.args.get('client_code', '').strip()
+    include_archived = request.args.get('include_archived') == '1'
     report_html = ""
     client_name = ""
 
@@ -33,35 +68,11 @@ def report_page():
 
         if client:
             client_name = f"{client['business_name']} (ID: {client['id']})"
+            totals = load_case_totals(db, source('money', include_archived), _client_cases(include_archived), (client['id'],))
+            report_html = _report_table(totals, "font-size:14px; margin-top:20px;")
 
-            c.execute("""
-                SELECT s.id as case_id,
-                       COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last) as debtor,
-                       m.type, m.amount
-                FROM cases s
-                LEFT JOIN money m ON s.id = m.case_id
-                WHERE s.client_id = %s
-            """, (client_code,))
-            rows = c.fetchall()
-
-            cases = {}
-            for r in rows:
-                case_id = r['case_id']
-                if case_id not in cases:
-                    cases[case_id] = {'debtor': r['debtor'], 'Invoice': 0.0, 'Payment': 0.0, 'Charge': 0.0, 'Interest': 0.0}
-                if r['type']:
-                    cases[case_id][r['type']] += float(r['amount'] or 0)
-
-            report_html = "<table border='1' style='width:100%; border-collapse:collapse; font-family:Arial; font-size:14px; margin-top:20px;'><tr style='background:#ddd;'><th>Case ID</th><th>Debtor</th><th>Invoice</th><th>Payment</th><th>Charge</th><th>Interest</th><th>Balance</th></tr>"
-            for case_id, d in cases.items():
-                balance = d['Invoice'] + d['Charge'] + d['Interest'] - d['Payment']
-                report_html += f"<tr><td>{case_id}</td><td>{d['debtor']}</td><td>£{d['Invoice']:.2f}</td><td>£{d['Payment']:.2f}</td><td>£{d['Charge']:.2f}</td><td>£{d['Interest']:.2f}</td><td>£{balance:.2f}</td></tr>"
-
-            grand = {t: sum(c[t] for c in cases.values()) for t in ['Invoice','Payment','Charge','Interest']}
-            grand_balance = grand['Invoice'] + grand['Charge'] + grand['Interest'] - grand['Payment']
-            report_html += f"<tr style='font-weight:bold; background:#eee;'><td colspan='2'>TOTALS</td><td>£{grand['Invoice']:.2f}</td><td>£{grand['Payment']:.2f}</td><td>£{grand['Charge']:.2f}</td><td>£{grand['Interest']:.2f}</td><td>£{grand_balance:.2f}</td></tr></table>"
-
-    return render_template('report.html', client_code=client_code, client_name=client_name, report_html=report_html)
+    return render_template('report.html', client_code=client_code, client_name=client_name,
+                           report_html=report_html, include_archived=include_archived)
 
 
 # ----------------------------------------------------------------------
@@ -69,8 +80,11 @@ def report_page():
 # ----------------------------------------------------------------------
 @reports_bp.route('/export_excel')
 @login_required
+@expensive('reports')
+@query_budget(REPORT_TIMEOUT_MS)
 def export_excel():
     client_code = request.args.get('client_code')
+    include_archived = request.args.get('include_archived') == '1'
     if not client_code:
         return "No client specified", 400
 
@@ -81,27 +95,16 @@ def export_excel():
     if not client:
         return "Client not found", 404
 
-    c.execute("""
-        SELECT s.id as case_id,
-               COALESCE(s.debtor_business_name, s.debtor_first || ' ' || s.debtor_last) as debtor,
-               m.type, m.amount
-        FROM cases s
-        LEFT JOIN money m ON s.id = m.case_id
-        WHERE s.client_id = %s
-    """, (client_code,))
-    rows = c.fetchall()
+    totals = load_case_totals(db, source('money', include_archived), _client_cases(include_archived), (client['id'],))
 
-    cases = {}
-    for r in rows:
-        case_id = r['case_id']
-        if case_id not in cases:
-            cases[case_id] = {'debtor': r['debtor'], 'Invoice': 0, 'Payment': 0, 'Charge': 0, 'Interest': 0}
-        if r['type']:
-            cases[case_id][r['type']] += r['amount']
+    import pandas as pd
 
-    df = pd.DataFrame.from_dict(cases, orient='index')
-    df = df.reset_index().rename(columns={'index': 'Case ID', 'debtor': 'Debtor'})
-    df['Balance'] = df['Invoice'] + df['Charge'] + df['Interest'] - df['Payment']
+    # exact pounds (Decimal), so Excel shows every total to the penny
+    df = pd.DataFrame({
+        'Case ID': totals.case_ids.tolist(),
+        'Debtor': totals.debtors,
+        **{k.title(): [pounds(p) for p in totals.columns[k]] for k in TOTAL_COLUMNS},
+    })
 
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -121,8 +124,11 @@ def export_excel():
 # ----------------------------------------------------------------------
 @reports_bp.route('/export_pdf')
 @login_required
+@expensive('reports')
+@query_budget(REPORT_TIMEOUT_MS)
 def export_pdf():
     client_code = request.args.get('client_code')
+    include_archived = request.args.get('include_archived') == '1'
     if not client_code:
         return "No client specified", 400
 
@@ -133,36 +139,153 @@ def export_pdf():
     if not client:
         return "Client not found", 404
 
-    c.execute("""
-        SELECT s.id as case_id, s.debtor_business_name, s.debtor_first, s.debtor_last,
-               m.type, m.amount
-        FROM cases s
-        LEFT JOIN money m ON s.id = m.case_id
-        WHERE s.client_id = %s
-    """, (client_code,))
-    rows = c.fetchall()
-
-    cases = {}
-    for r in rows:
-        case_id = r['case_id']
-        if case_id not in cases:
-            debtor = r['debtor_business_name'] or f"{r['debtor_first']} {r['debtor_last']}"
-            cases[case_id] = {'debtor': debtor, 'Invoice': 0.0, 'Payment': 0.0, 'Charge': 0.0, 'Interest': 0.0}
-        if r['type']:
-            cases[case_id][r['type']] += float(r['amount'] or 0)
-
+    totals = load_case_totals(db, source('money', include_archived), _client_cases(include_archived), (client['id'],))
     html = f"<h1>Client Report: {client['business_name']} (ID: {client['id']})</h1>"
-    html += "<table border='1' style='width:100%; border-collapse:collapse; font-family:Arial; font-size:12px;'><tr style='background:#ddd;'><th>Case ID</th><th>Debtor</th><th>Invoice</th><th>Payment</th><th>Charge</th><th>Interest</th><th>Balance</th></tr>"
-    for case_id, d in cases.items():
-        balance = d['Invoice'] + d['Charge'] + d['Interest'] - d['Payment']
-        html += f"<tr><td>{case_id}</td><td>{d['debtor']}</td><td>£{d['Invoice']:.2f}</td><td>£{d['Payment']:.2f}</td><td>£{d['Charge']:.2f}</td><td>£{d['Interest']:.2f}</td><td>£{balance:.2f}</td></tr>"
+    html += _report_table(totals, "font-size:12px;")
 
-    grand = {t: sum(c[t] for c in cases.values()) for t in ['Invoice','Payment','Charge','Interest']}
-    grand_balance = grand['Invoice'] + grand['Charge'] + grand['Interest'] - grand['Payment']
-    html += f"<tr style='font-weight:bold; background:#eee;'><td colspan='2'>TOTALS</td><td>£{grand['Invoice']:.2f}</td><td>£{grand['Payment']:.2f}</td><td>£{grand['Charge']:.2f}</td><td>£{grand['Interest']:.2f}</td><td>£{grand_balance:.2f}</td></tr></table>"
+    from weasyprint import HTML
 
     pdf = HTML(string=html).write_pdf()
     response = make_response(pdf)
     response.headers['Content-Type'] = 'application/pdf'
     response.headers['Content-Disposition'] = f'attachment; filename=report_client_{client_code}.pdf'
     return response
+
+
+# ----------------------------------------------------------------------
+#  3b. Client statement for a period (same template as the batch run)
+# ----------------------------------------------------------------------
+@reports_bp.route('/statement')
+@login_required
+@expensive('reports')
+@query_budget(REPORT_TIMEOUT_MS)
+def client_statement():
+    client_code = request.args.get('client_code', '').strip()
+    if not client_code.isdigit():
+        return "No client specified", 400
+    last_month_end = date.today().replace(day=1) - timedelta(days=1)
+    try:
+        start = date.fromisoformat(request.args.get('start') or last_month_end.replace(day=1).isoformat())
+        end = date.fromisoformat(request.args.get('end') or last_month_end.isoformat())
+    except ValueError:
+        return "Dates must be YYYY-MM-DD", 400
+    if start > end:
+        return "Start date is after the end date", 400
+
+    db = get_db()
+    statement = next(iter_statement_data(db, start, end, [int(client_code)]), None)
+    db.commit()   # close the named cursor
+    if statement is None:
+        return f"No transactions for client {client_code} between {start} and {end}", 404
+
+    pdf, _, _ = statement_pdf(statement, start, end)
+    response = make_response(pdf)
+    response.headers['Content-Type'] = 'application/pdf'
+    response.headers['Content-Disposition'] = f'attachment; filename={statement_filename(client_code, start, end)}'
+    return response
+
+
+# ----------------------------------------------------------------------
+#  4. Nightly snapshots + aged debt refresh
+# ----------------------------------------------------------------------
+def take_snapshot(db, as_of=None):
+    """Per-case and per-client balances as at the end of as_of (default today).
+    Safe to re-run for the same day - the rows are just overwritten."""
+    as_of = as_of or date.today()
+    c = db.cursor()
+    c.execute(f"""
+        INSERT INTO balance_snapshots (snapshot_date, case_id, client_id, invoice_pence, payment_pence,
+                                       charge_pence, interest_pence, balance_pence)
+        SELECT %(d)s, s.id, s.client_id,
+               {totals_columns('m')}
+        FROM cases s
+        LEFT JOIN money_all m ON m.case_id = s.id AND m.transaction_date <= %(d)s
+        GROUP BY s.id
+        ON CONFLICT (snapshot_date, case_id) DO UPDATE
+        SET client_id = EXCLUDED.client_id, invoice_pence = EXCLUDED.invoice_pence,
+            payment_pence = EXCLUDED.payment_pence, charge_pence = EXCLUDED.charge_pence,
+            interest_pence = EXCLUDED.interest_pence, balance_pence = EXCLUDED.balance_pence
+    """, {'d': as_of})
+    cases = c.rowcount
+    c.execute("""
+        INSERT INTO client_balance_snapshots (snapshot_date, client_id, case_count, balance_pence)
+        SELECT snapshot_date, client_id, COUNT(*), SUM(balance_pence)
+        FROM balance_snapshots
+        WHERE snapshot_date = %s
+        GROUP BY snapshot_date, client_id
+        ON CONFLICT (client_id, snapshot_date) DO UPDATE
+        SET case_count = EXCLUDED.case_count, balance_pence = EXCLUDED.balance_pence
+    """, (as_of,))
+    db.commit()
+    return cases
+
+
+def refresh_aged_debt(db):
+    # CONCURRENTLY keeps /report/aged_debt readable while it rebuilds
+    db.cursor().execute("REFRESH MATERIALIZED VIEW CONCURRENTLY aged_debt_mv")
+    db.commit()
+
+
+reports_cli = AppGroup('reports', help='Nightly reporting jobs.')
+
+
+@reports_cli.command('nightly')
+@click.option('--date', 'as_of', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Snapshot date (default today). Use to backfill.')
+def reports_nightly(as_of):
+    db = get_db()
+    cases = take_snapshot(db, as_of.date() if as_of else None)
+    click.echo(f"Snapshot: {cases} cases")
+    refresh_aged_debt(db)
+    click.echo("aged_debt_mv refreshed")
+
+
+# ----------------------------------------------------------------------
+#  5. Aged debt – whole portfolio, straight from aged_debt_mv
+# ----------------------------------------------------------------------
+@reports_bp.route('/report/aged_debt')
+@login_required
+def aged_debt():
+    db = get_db()
+    c = db.cursor()
+    c.execute("""
+        SELECT a.*, cl.business_name
+        FROM aged_debt_mv a
+        JOIN clients cl ON cl.id = a.client_id
+        ORDER BY a.balance_pence DESC
+    """)
+    rows = c.fetchall()
+    buckets = ['pence_0_30', 'pence_31_60', 'pence_61_90', 'pence_90_plus', 'balance_pence']
+    totals = {b: sum(r[b] for r in rows) for b in buckets}
+    refreshed_at = rows[0]['refreshed_at'] if rows else None
+    return render_template('aged_debt.html', rows=rows, totals=totals, refreshed_at=refreshed_at)
+
+
+# ----------------------------------------------------------------------
+#  6. Balance trend – one client, from the nightly snapshots
+# ----------------------------------------------------------------------
+@reports_bp.route('/report/trend')
+@login_required
+def balance_trend():
+    client_code = request.args.get('client_code', '').strip()
+    days = int(request.args.get('days', 90))
+    client = None
+    points = []
+
+    if client_code:
+        db = get_db()
+        c = db.cursor()
+        c.execute("SELECT id, business_name FROM clients WHERE id = %s", (client_code,))
+        client = c.fetchone()
+        if client:
+            c.execute("""
+                SELECT snapshot_date, case_count, balance_pence
+                FROM client_balance_snapshots
+                WHERE client_id = %s AND snapshot_date >= %s
+                ORDER BY snapshot_date
+            """, (client['id'], date.today() - timedelta(days=days)))
+            points = c.fetchall()
+
+    peak = max((abs(p['balance_pence']) for p in points), default=0) or 1
+    return render_template('balance_trend.html', client_code=client_code, client=client,
+                           points=points, peak=peak, days=days)
@@ -0,0 +1,238 @@
+# =============================================================================
+#  STATEMENTS - PERIOD STATEMENTS FOR EVERY CLIENT, AS PDFs
+#  • One aggregated query streams one row per client: every case with money
+#    in the period, with its opening / closing balance and that period's
+#    transactions (as JSON), built in Postgres with balances.signed_pence()
+#  • Each row is rendered through templates/statement.html (Jinja) and
+#    WeasyPrint in a pool of worker processes. The logo, the parsed
+#    stylesheet (static/statement.css) and the font setup are loaded once
+#    per worker, not once per PDF.
+#  • Workers come from a forkserver, so they never inherit the batch's DB
+#    connection - they only get data and write files
+#  • Every document is timed (HTML, PDF, bytes) into manifest.csv next to
+#    the PDFs, with a summary at the end
+#  Batch run (cron at month end):
+#    flask --app app statements run --start 2026-09-01 --end 2026-09-30 --out statements/2026-09
+#  One client on screen: /statement?client_code=3&start=...&end=... (routes/reports.py)
+# =============================================================================
+
+import base64
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import date
+import click
+from flask.cli import AppGroup
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from extensions import get_db, format_date
+from balances import TYPES, signed_pence, format_money
+
+STATEMENT_WORKERS = int(os.environ.get('STATEMENT_WORKERS', os.cpu_count() or 2))
+STATEMENT_LOGO = os.environ.get('STATEMENT_LOGO', 'redwood-logo.png')
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(_ROOT, 'templates')
+STATIC_DIR = os.path.join(_ROOT, 'static')
+
+
+# ----------------------------------------------------------------------
+#  DATA - one row per client with activity in the period
+# ----------------------------------------------------------------------
+STATEMENT_SQL = f"""
+    WITH per_case AS (
+        SELECT m.case_id,
+               COALESCE(SUM({signed_pence('m')}) FILTER (WHERE m.transaction_date < %(start)s), 0)::bigint AS opening_pence,
+               COALESCE(SUM({signed_pence('m')}), 0)::bigint AS closing_pence,
+               json_agg(json_build_object(
+                   'date', m.transaction_date, 'type', m.type, 'description', m.description,
+                   'amount_pence', m.amount_pence, 'signed_pence', {signed_pence('m')}
+               ) ORDER BY m.transaction_date, m.id) FILTER (WHERE m.transaction_date >= %(start)s) AS transactions
+        FROM money_all m
+        JOIN cases s ON s.id = m.case_id
+        WHERE m.transaction_date <= %(end)s
+          AND (%(client_ids)s::int[] IS NULL OR s.client_id = ANY(%(client_ids)s::int[]))
+        GROUP BY m.case_id
+    )
+    SELECT cl.id AS client_id, cl.business_name, cl.contact_first, cl.contact_last, cl.email, cl.bacs_details,
+           json_agg(json_build_object(
+               'case_id', s.id,
+               'debtor', COALESCE(NULLIF(s.debtor_business_name, ''), s.debtor_first || ' ' || s.debtor_last),
+               'status', s.status,
+               'opening_pence', p.opening_pence,
+               'closing_pence', p.closing_pence,
+               'transactions', p.transactions
+           ) ORDER BY s.id) AS cases
+    FROM per_case p
+    JOIN cases s ON s.id = p.case_id
+    JOIN clients cl ON cl.id = s.client_id
+    WHERE p.transactions IS NOT NULL
+    GROUP BY cl.id
+    ORDER BY cl.id
+"""
+
+
+def iter_statement_data(db, start, end, client_ids=None, batch_rows=50):
+    """Yield each client's statement data (a dict), streamed from a server-side cursor."""
+    with db.cursor(name='statements') as c:
+        c.itersize = batch_rows
+        c.execute(STATEMENT_SQL, {'start': start, 'end': end, 'client_ids': client_ids})
+        for row in c:
+            yield row
+
+
+def _totals(statement):
+    """Period totals per type, per case and for the whole statement - pence, exact."""
+    grand = {t: 0 for t in TYPES}
+    for case in statement['cases']:
+        case['totals'] = {t: 0 for t in TYPES}
+        for t in case['transactions']:
+            if t['signed_pence']:   # non-recoverable charges are listed, not totalled - so the totals reconcile
+                case['totals'][t['type']] += t['amount_pence']
+        for t in TYPES:
+            grand[t] += case['totals'][t]
+    statement['totals'] = grand
+    statement['opening_pence'] = sum(c['opening_pence'] for c in statement['cases'])
+    statement['closing_pence'] = sum(c['closing_pence'] for c in statement['cases'])
+    statement['transaction_count'] = sum(len(c['transactions']) for c in statement['cases'])
+    return statement
+
+
+# ----------------------------------------------------------------------
+#  RENDERING - assets are loaded once per process
+# ----------------------------------------------------------------------
+_assets = None
+
+
+def _load_assets():
+    global _assets
+    if _assets is None:
+        from weasyprint import CSS
+        from weasyprint.text.fonts import FontConfiguration
+        env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+        env.filters['money'] = format_money
+        env.filters['format_date'] = format_date
+        with open(os.path.join(STATIC_DIR, STATEMENT_LOGO), 'rb') as f:
+            logo = 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+        fonts = FontConfiguration()
+        _assets = {
+            'template': env.get_template('statement.html'),
+            'logo': logo,
+            'fonts': fonts,
+            'css': CSS(filename=os.path.join(STATIC_DIR, 'statement.css'), font_config=fonts),
+        }
+    return _assets
+
+
+def statement_pdf(statement, start, end):
+    """(pdf bytes, html ms, pdf ms) for one client's statement data."""
+    from weasyprint import HTML
+    assets = _load_assets()
+    t0 = time.perf_counter()
+    html = assets['template'].render(s=_totals(statement), start=start, end=end,
+                                     logo=assets['logo'], issued=date.today())
+    t1 = time.perf_counter()
+    pdf = HTML(string=html, base_url=STATIC_DIR).write_pdf(stylesheets=[assets['css']],
+                                                            font_config=assets['fonts'])
+    t2 = time.perf_counter()
+    return pdf, (t1 - t0) * 1000, (t2 - t1) * 1000
+
+
+def statement_filename(client_id, start, end):
+    return f"statement_{client_id}_{start}_{end}.pdf"
+
+
+def _render_to_file(statement, start, end, out_dir):
+    # runs in a worker process
+    started = time.perf_counter()
+    pdf, html_ms, pdf_ms = statement_pdf(statement, start, end)
+    name = statement_filename(statement['client_id'], start, end)
+    with open(os.path.join(out_dir, name), 'wb') as f:
+        f.write(pdf)
+    return {
+        'client_id': statement['client_id'],
+        'file': name,
+        'cases': len(statement['cases']),
+        'transactions': statement['transaction_count'],
+        'bytes': len(pdf),
+        'html_ms': round(html_ms, 1),
+        'pdf_ms': round(pdf_ms, 1),
+        'total_ms': round((time.perf_counter() - started) * 1000, 1),
+        'worker': os.getpid(),
+    }
+
+
+# ----------------------------------------------------------------------
+#  BATCH
+# ----------------------------------------------------------------------
+def run_statements(db, start, end, out_dir, client_ids=None, workers=STATEMENT_WORKERS, on_done=None):
+    """Render every client's statement for the period into out_dir. Returns the per-document timings.
+    At most workers * 4 statements are queued at once, so memory stays flat however many clients."""
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+    pending = set()
+
+    def collect(done):
+        for future in done:
+            result = future.result()
+            results.append(result)
+            if on_done:
+                on_done(result)
+
+    ctx = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_load_assets) as pool:
+        for statement in iter_statement_data(db, start, end, client_ids):
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(_render_to_file, statement, start, end, out_dir))
+        db.commit()   # close the streaming cursor's transaction while the last PDFs finish
+        collect(wait(pending)[0])
+    results.sort(key=lambda r: r['client_id'])
+    return results
+
+
+def write_manifest(out_dir, results):
+    path = os.path.join(out_dir, 'manifest.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['client_id', 'file', 'cases', 'transactions', 'bytes',
+                                               'html_ms', 'pdf_ms', 'total_ms', 'worker'])
+        writer.writeheader()
+        writer.writerows(results)
+    return path
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+# =============================================================================
+#  CLI - registered in app.py
+# =============================================================================
+
+statements_cli = AppGroup('statements', help='Client period statements (PDF).')
+
+
+@statements_cli.command('run')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']), required=True)
+@click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']), required=True)
+@click.option('--out', 'out_dir', default=None, help='Folder for the PDFs (default statements/<start>_<end>).')
+@click.option('--client', 'client_ids', type=int, multiple=True, help='Only these clients (repeatable).')
+@click.option('--workers', type=int, default=STATEMENT_WORKERS, show_default=True)
+def statements_run(start, end, out_dir, client_ids, workers):
+    start, end = start.date(), end.date()
+    out_dir = out_dir or os.path.join('statements', f"{start}_{end}")
+    began = time.perf_counter()
+    results = run_statements(get_db(), start, end, out_dir, list(client_ids) or None, workers,
+                             on_done=lambda r: click.echo(f"  client {r['client_id']}: {r['cases']} cases, "
+                                                          f"{r['total_ms']:.0f} ms", err=True))
+    elapsed = time.perf_counter() - began
+    manifest = write_manifest(out_dir, results)
+    times = [r['total_ms'] for r in results]
+    click.echo(f"{len(results)} statements in {elapsed:.1f}s with {workers} workers "
+               f"({len(results) / elapsed if elapsed else 0:.1f}/s) -> {out_dir}")
+    if results:
+        click.echo(f"per document: p50 {_percentile(times, 0.5):.0f} ms, p95 {_percentile(times, 0.95):.0f} ms, "
+                   f"max {max(times):.0f} ms. Timings in {manifest}")
@@ -0,0 +1,56 @@
+# =============================================================================
+#  TESTS - run against a real Postgres, never the live one
+#      TEST_DATABASE_URL=postgresql://.../harbour_test python -m pytest tests
+#  The database must exist; init_db runs on it once per session. Each test
+#  gets a connection that is rolled back afterwards, so nothing is kept.
+#  Without TEST_DATABASE_URL every DB test is skipped.
+# =============================================================================
+
+import os
+import sys
+import pytest
+import psycopg
+from psycopg.rows import dict_row
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+if TEST_DATABASE_URL:
+    os.environ.setdefault('DATABASE_URL', TEST_DATABASE_URL)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def database():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL isn't set")
+    import init_db
+    init_db.init_db(TEST_DATABASE_URL)
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def db(database):
+    conn = psycopg.connect(database, row_factory=dict_row)
+    yield conn
+    conn.rollback()
+    conn.close()
+
+
+@pytest.fixture
+def user_id(db):
+    c = db.cursor()
+    c.execute("INSERT INTO users (username, password_hash, role) VALUES ('test-user', 'x', 'user') RETURNING id")
+    return c.fetchone()['id']
+
+
+@pytest.fixture
+def new_case(db):
+    """new_case(**columns) -> case id, under a fresh client."""
+    def make(**columns):
+        c = db.cursor()
+        c.execute("INSERT INTO clients (business_type, business_name) VALUES ('Ltd', 'Test client') RETURNING id")
+        columns = {'debtor_first': 'Test', 'debtor_last': 'Debtor', 'status': 'Open', **columns,
+                   'client_id': c.fetchone()['id']}
+        c.execute(f"INSERT INTO cases ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) RETURNING id",
+                  list(columns.values()))
+        return c.fetchone()['id']
+    return make
@@ -0,0 +1,45 @@
+from datetime import date, timedelta
+
+
+def _add(db, case_id, user_id, kind, pence, days_ago):
+    db.execute("""
+        INSERT INTO money (case_id, type, amount_pence, created_by, recoverable, transaction_date)
+        VALUES (%s, %s, %s, %s, 1, %s)
+    """, (case_id, kind, pence, user_id, date.today() - timedelta(days=days_ago)))
+
+
+def _aged(db, case_id):
+    db.execute("REFRESH MATERIALIZED VIEW aged_debt_mv")
+    return db.execute("""
+        SELECT a.pence_0_30, a.pence_31_60, a.pence_61_90, a.pence_90_plus, a.balance_pence
+        FROM aged_debt_mv a JOIN cases s ON s.client_id = a.client_id WHERE s.id = %s
+    """, (case_id,)).fetchone()
+
+
+def test_recent_part_payment_pays_off_the_oldest_invoice(db, user_id, new_case):
+    case_id = new_case()
+    _add(db, case_id, user_id, 'Invoice', 100_00, 120)
+    _add(db, case_id, user_id, 'Invoice', 50_00, 45)
+    _add(db, case_id, user_id, 'Payment', 30_00, 5)
+
+    assert _aged(db, case_id) == {'pence_0_30': 0, 'pence_31_60': 50_00, 'pence_61_90': 0,
+                                  'pence_90_plus': 70_00, 'balance_pence': 120_00}
+
+
+def test_payment_spills_onto_the_next_invoice(db, user_id, new_case):
+    case_id = new_case()
+    _add(db, case_id, user_id, 'Invoice', 100_00, 120)
+    _add(db, case_id, user_id, 'Invoice', 50_00, 45)
+    _add(db, case_id, user_id, 'Payment', 120_00, 5)
+
+    assert _aged(db, case_id) == {'pence_0_30': 0, 'pence_31_60': 30_00, 'pence_61_90': 0,
+                                  'pence_90_plus': 0, 'balance_pence': 30_00}
+
+
+def test_overpayment_shows_as_current_credit(db, user_id, new_case):
+    case_id = new_case()
+    _add(db, case_id, user_id, 'Invoice', 100_00, 120)
+    _add(db, case_id, user_id, 'Payment', 130_00, 5)
+
+    assert _aged(db, case_id) == {'pence_0_30': -30_00, 'pence_31_60': 0, 'pence_61_90': 0,
+                                  'pence_90_plus': 0, 'balance_pence': -30_00}
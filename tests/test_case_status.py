@@ -0,0 +1,35 @@
+from routes.case_api import change_status
+
+
+def _history(db, case_id):
+    return db.execute("SELECT old_status, new_status FROM case_status_history WHERE case_id = %s ORDER BY id",
+                      (case_id,)).fetchall()
+
+
+def test_status_change_on_a_case_with_a_next_action_date(db, user_id, new_case):
+    case_id = new_case(next_action_date='2026-11-02')
+
+    case = change_status(db, case_id, 'On Hold', None, '2026-11-02', user_id)
+
+    assert case['status'] == 'On Hold'
+    assert case['next_action_date'] == '2026-11-02'
+    assert _history(db, case_id) == [{'old_status': 'Open', 'new_status': 'On Hold'}]
+
+
+def test_only_the_next_action_date_changing_is_recorded(db, user_id, new_case):
+    case_id = new_case(next_action_date='2026-11-02')
+
+    change_status(db, case_id, 'Open', None, '2026-11-09', user_id)
+
+    assert _history(db, case_id) == [{'old_status': 'Open', 'new_status': 'Open'}]
+
+
+def test_nothing_changed_records_no_history(db, user_id, new_case):
+    case_id = new_case(next_action_date='2026-11-02')
+    blank_id = new_case(next_action_date='')
+
+    change_status(db, case_id, 'Open', None, '2026-11-02', user_id)
+    change_status(db, blank_id, 'Open', None, None, user_id)
+
+    assert _history(db, case_id) == []
+    assert _history(db, blank_id) == []